@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the git-super-status prompt path against generated repositories.
+
+Repositories with increasing numbers of tracked files are generated once
+under a work directory (and reused by later runs), each in a few states:
+clean, dirty (staged, modified, untracked and stashed files) and conflicted
+(a merge stopped on conflicts on top of the dirty state). Every way the
+prompt can get its status is then timed against them:
+
+    stdin   `git status --porcelain=v2 --branch -z | git-super-status-parser.py`
+    spawn   `git-super-status-parser.py --spawn`, the parser runs git itself
+    precmd  `precmd-git-super-status` and `git-super-status-prompt` in zsh,
+            skipped when zsh isn't installed
+
+Reported per run are the wall time, the peak RSS of the biggest process in
+the tree (from wait4) and the processes forked while it ran (the delta of the
+`processes` counter in /proc/stat, which is system wide and counts threads
+too, so git's preload threads and anything else running show up in it).
+
+Usage:
+    ./git-super-status-bench.py --sizes 1000,10000 --save base.json
+    ./git-super-status-bench.py --sizes 1000,10000 --baseline base.json
+
+With --baseline the exit status is 1 when a median wall time grew by more
+than --tolerance percent.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess as sub
+import sys
+import tempfile
+import time
+
+HERE_D = os.path.dirname(os.path.abspath(__file__))
+PARSER = os.path.join(HERE_D, 'git-super-status-parser.py')
+SHELL_GLUE = os.path.join(HERE_D, 'git-super-status.sh')
+# Tracked files per generated directory
+FILES_PER_DIR = 1000
+STATES = ('clean', 'dirty', 'conflict')
+MODES = ('stdin', 'spawn', 'precmd')
+# Quiet, reproducible git for the generated repositories
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@example.com',
+               GIT_CONFIG_NOSYSTEM='1', HOME=tempfile.gettempdir())
+# Monotonic where the interpreter has it
+clock = getattr(time, 'monotonic', time.time)
+
+
+def git(repo_d, *args, **kwargs):
+    """
+    Run git in repo_d, raising on failure unless check=False.
+
+    Returns: The exit status
+    """
+    check = kwargs.pop('check', True)
+    with open(os.devnull, 'w') as devnull:
+        status = sub.call(('git',) + args, cwd=repo_d, env=GIT_ENV,
+                          stdout=devnull, stderr=devnull, **kwargs)
+    if check and status:
+        raise RuntimeError('git {0} failed in {1}'.format(' '.join(args), repo_d))
+    return status
+
+
+def file_path(repo_d, index):
+    """
+    The path of the index-th generated file, FILES_PER_DIR to a directory.
+    """
+    return os.path.join(repo_d, 'd{0:04d}'.format(index // FILES_PER_DIR), 'f{0:07d}.txt'.format(index))
+
+
+def write_files(repo_d, indexes, text):
+    for index in indexes:
+        path = file_path(repo_d, index)
+        try:
+            fout = open(path, 'w')
+        except IOError:
+            os.makedirs(os.path.dirname(path))
+            fout = open(path, 'w')
+        with fout:
+            fout.write('{0} {1}\n'.format(text, index))
+
+
+def dirtied(size):
+    """
+    How many files each kind of change touches in a repository of size files.
+    """
+    return max(10, size // 1000)
+
+
+def make_repo(repo_d, size, state):
+    """
+    Generate a repository of size tracked files in state, see STATES.
+
+    The clean repository has an upstream one commit behind and one ahead so
+    the ahead/behind walk is exercised too.
+    """
+    os.makedirs(repo_d)
+    git(repo_d, 'init', '-q', '-b', 'main')
+    write_files(repo_d, range(size), 'base')
+    git(repo_d, 'add', '-A')
+    git(repo_d, 'commit', '-q', '-m', 'base')
+    git(repo_d, 'branch', 'upstream')
+    git(repo_d, 'config', 'branch.main.remote', '.')
+    git(repo_d, 'config', 'branch.main.merge', 'refs/heads/upstream')
+    git(repo_d, 'checkout', '-q', 'upstream')
+    write_files(repo_d, range(1), 'theirs')
+    git(repo_d, 'commit', '-q', '-am', 'theirs')
+    git(repo_d, 'checkout', '-q', 'main')
+    write_files(repo_d, range(1), 'ours')
+    git(repo_d, 'commit', '-q', '-am', 'ours')
+    if state == 'clean':
+        return
+
+    count = dirtied(size)
+    for stash in range(3):
+        write_files(repo_d, range(1, 1 + count), 'stash {0}'.format(stash))
+        git(repo_d, 'stash', '-q')
+    if state == 'conflict':
+        # both sides changed the first file
+        git(repo_d, 'merge', 'upstream', check=False)
+    write_files(repo_d, range(1, 1 + count), 'staged')
+    git(repo_d, 'add', '--', *[os.path.relpath(file_path(repo_d, index), repo_d) for index in range(1, 1 + count)])
+    write_files(repo_d, range(1 + count, 1 + 2 * count), 'modified')
+    write_files(repo_d, range(size, size + count), 'untracked')
+
+
+def repo_for(work_d, size, state):
+    """
+    Return the path of the generated repository, making it on first use.
+    """
+    repo_d = os.path.join(work_d, '{0}-{1}'.format(size, state))
+    if not os.path.isdir(os.path.join(repo_d, '.git')):
+        if os.path.isdir(repo_d):
+            shutil.rmtree(repo_d)
+        sys.stderr.write('generating {0} ...\n'.format(repo_d))
+        make_repo(repo_d, size, state)
+        # settle the index stat cache like a repo that has been in use
+        git(repo_d, 'status', '--porcelain')
+    return repo_d
+
+
+def forks_so_far():
+    """
+    Returns: The number of processes forked since boot, None when unknown
+    """
+    try:
+        with open('/proc/stat') as fin:
+            for line in fin:
+                if line.startswith('processes '):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def measure(command, cwd):
+    """
+    Run command once.
+
+    Returns: (wall seconds, peak RSS in KiB, forks or None)
+    """
+    forks = forks_so_far()
+    start = clock()
+    with open(os.devnull, 'w') as devnull:
+        proc = sub.Popen(command, cwd=cwd, stdout=devnull, stderr=devnull)
+        _, status, usage = os.wait4(proc.pid, 0)
+    wall = clock() - start
+    proc.returncode = status
+    after = forks_so_far()
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return wall, rss, None if forks is None or after is None else after - forks - 1
+
+
+def mode_command(mode, python, zsh):
+    """
+    The command that computes one prompt the way mode does.
+    """
+    if mode == 'stdin':
+        return ['sh', '-c', 'git status --porcelain=v2 --branch -z | "$0" "$1"', python, PARSER]
+    if mode == 'spawn':
+        return [python, PARSER, '--spawn']
+    return [zsh, '-f', '-c', 'source "$0" && precmd-git-super-status && git-super-status-prompt', SHELL_GLUE]
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(args):
+    """
+    Time every mode against every generated repository.
+
+    Returns: A list of result dicts
+    """
+    zsh = find_program('zsh')
+    results = []
+    for size in args.sizes:
+        for state in args.states:
+            repo_d = repo_for(args.work_dir, size, state)
+            for mode in args.modes:
+                if mode == 'precmd' and not zsh:
+                    continue
+                command = mode_command(mode, args.python, zsh)
+                measure(command, repo_d)  # warm the page cache
+                samples = [measure(command, repo_d) for _ in range(args.runs)]
+                forks = [sample[2] for sample in samples if sample[2] is not None]
+                results.append({
+                    'size': size, 'state': state, 'mode': mode,
+                    'wall_ms': median([sample[0] for sample in samples]) * 1000,
+                    'rss_kib': max(sample[1] for sample in samples),
+                    'forks': median(forks) if forks else None,
+                })
+                print_result(results[-1])
+    return results
+
+
+def find_program(name):
+    for path_d in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(path_d, name)
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def print_result(result, baseline=None):
+    line = '{size:>8} {state:<9} {mode:<7} {wall_ms:>10.1f} {rss_kib:>10} {forks:>6}'.format(
+        **dict(result, forks='?' if result['forks'] is None else result['forks']))
+    if baseline:
+        line += ' {0:>+8.1f}%'.format((result['wall_ms'] / baseline['wall_ms'] - 1) * 100)
+    print(line)
+    sys.stdout.flush()
+
+
+def result_key(result):
+    return result['size'], result['state'], result['mode']
+
+
+def compare(results, baseline_file, tolerance):
+    """
+    Print the change from a saved run.
+
+    Returns: The results that got slower by more than tolerance percent
+    """
+    with open(baseline_file) as fin:
+        baseline = dict((result_key(result), result) for result in json.load(fin))
+    slower = []
+    print('\nagainst {0}:'.format(baseline_file))
+    for result in results:
+        before = baseline.get(result_key(result))
+        if before:
+            print_result(result, before)
+            if result['wall_ms'] > before['wall_ms'] * (1 + tolerance / 100.0):
+                slower.append(result)
+    return slower
+
+
+def comma_ints(text):
+    return [int(value) for value in text.split(',') if value]
+
+
+def comma_choices(choices):
+    def parse(text):
+        values = [value for value in text.split(',') if value]
+        unknown = set(values) - set(choices)
+        if unknown:
+            raise argparse.ArgumentTypeError('unknown: {0}'.format(', '.join(sorted(unknown))))
+        return values
+    return parse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the git-super-status prompt path')
+    parser.add_argument('--sizes', type=comma_ints, default=[1000, 10000, 100000, 1000000],
+                        help='comma separated numbers of tracked files, default 1000,10000,100000,1000000')
+    parser.add_argument('--states', type=comma_choices(STATES), default=list(STATES),
+                        help='comma separated subset of ' + ','.join(STATES))
+    parser.add_argument('--modes', type=comma_choices(MODES), default=list(MODES),
+                        help='comma separated subset of ' + ','.join(MODES))
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per case, the median is reported')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'git-super-status-bench'),
+                        help='where the generated repositories are kept between runs')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to run the parser with')
+    parser.add_argument('--save', metavar='FILE', help='write the results as json')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=10,
+                        help='percent a median wall time may grow before --baseline fails, default 10')
+    args = parser.parse_args()
+
+    print('{0:>8} {1:<9} {2:<7} {3:>10} {4:>10} {5:>6}'.format('files', 'state', 'mode', 'wall ms', 'rss KiB', 'forks'))
+    results = run(args)
+    if args.save:
+        with open(args.save, 'w') as fout:
+            json.dump(results, fout, indent=1)
+    if args.baseline and compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,33 +5,116 @@ Retrieve information about the git repository in CWD.
 
 Invoked by ./zshrc.sh automatically.
 """
+import argparse
+import array
+import binascii
+import errno
+import fcntl
+import hashlib
+import heapq
+import json
+import multiprocessing
 import os
+import socket
+import stat
+import struct
 import subprocess as sub
 import sys
+import threading
+import time
+import zlib
 try:
     import urllib.request as urllib
 except:
     import urllib
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
 
 # Denotes no upstream set, impossible branch name per git ref spec
 SYM_NOUPSTREAM = '..'
 # This symbol appears before hashes when detached
 SYM_PREHASH = os.environ.get('ZSH_THEME_GIT_PROMPT_HASH_PREFIX', ':')
+# Stands in for numbers that were not computed, e.g. when git status timed out
+SYM_UNKNOWN = '?'
+# Bytes read from git status at a time, the whole output is never held at once
+CHUNK_SIZE = 65536
+# The fields of the status line in order, see current_git_status and status_record
+STATUS_FIELDS = ('branch', 'ahead', 'behind', 'staged', 'conflicts', 'changed', 'untracked',
+                 'stashes', 'local', 'upstream', 'merge', 'rebase', 'root', 'sub_dirty', 'sub_commit')
+# Set to report submodules with changes and at another commit than the superproject records
+SUBMODULES = os.environ.get('ZSH_GIT_PROMPT_SUBMODULES', '') not in ('', '0')
+# Gitlinks of an index by its path, see index_gitlinks
+GITLINK_CACHE = {}
+# Longest a clean status is re-served by the index stat check without running git status, see IndexStat
+CLEAN_MAX = float(os.environ.get('ZSH_GIT_PROMPT_CLEAN_MAX', '60') or 0)
+# How long a terminal waits for another one computing the same status, see SharedStatusCache
+SHARED_WAIT = 10
+# Path to .git by directory, see find_git_root
+ROOT_CACHE = {}
+# Most commits walked to count ahead/behind without git before giving up, 0 to not walk
+WALK_LIMIT = int(os.environ.get('ZSH_GIT_PROMPT_WALK_LIMIT', '20000') or 0)
+# Commits the ahead/behind walk visits past where it could stop, git's SLOP
+WALK_SLOP = 5
+# Parsed files by path with the version they were parsed from, see cached_load
+FILE_CACHE = {}
+# (ahead, behind) by (branch id, upstream id), commit ids never change meaning
+AHEAD_BEHIND_CACHE = {}
+# Counts stop at this many and print as e.g. `999+`, 0 to always count everything
+MAX_COUNT = int(os.environ.get('ZSH_GIT_PROMPT_MAX_COUNT', '0') or 0)
+# Seconds the daemon waits for a request before exiting, 0 to never exit
+DAEMON_IDLE = int(os.environ.get('ZSH_GIT_PROMPT_DAEMON_IDLE', '3600') or 0)
+# Seconds a cached status is trusted when only mtimes can invalidate it, 0 to not cache
+CACHE_TTL = float(os.environ.get('ZSH_GIT_PROMPT_CACHE_TTL', '5') or 0)
+# Most directories watched per repository before falling back to mtimes, 0 to not use inotify
+INOTIFY_MAX = int(os.environ.get('ZSH_GIT_PROMPT_INOTIFY_MAX', '20000') or 0)
+# Most repositories the daemon keeps cached and watched at once
+CACHE_MAX_ROOTS = 16
+# Phase timings are logged when set, the shell exports it for each prompt while ZSH_GIT_PROMPT_TRACE=1
+TRACE_ID = os.environ.get('__GSS_TRACE_ID') or (
+    os.environ.get('ZSH_GIT_PROMPT_TRACE') == '1' and str(os.getpid())) or ''
+# Most lines kept in the trace log, it is cut back to this when it grows to about four times that
+TRACE_MAX = int(os.environ.get('ZSH_GIT_PROMPT_TRACE_MAX', '20000') or 0)
+# Bytes of the trace log's tail read back to keep TRACE_MAX lines
+TRACE_MAX_BYTES = TRACE_MAX * 60
+# The trace records of the request being served by this thread
+TRACE_LOCAL = threading.local()
+# git-super-status-util.py, loaded on first use by load_util
+UTIL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'git-super-status-util.py')
+UTIL = None
+# Monotonic where the interpreter has it
+clock = getattr(time, 'monotonic', time.time)
 
 
-def find_git_root():
+def find_git_root(working_d=None):
     """
     Find the nearest enclosing git root (i.e. the path to .git).
+    Answers from ROOT_CACHE while the .git found there still exists and the
+    directory hasn't grown a .git of its own, the shell glue seeds it with
+    the root it found on chpwd (see --root).
+
+    Args:
+        working_d: The directory to start from, defaults to the CWD
 
     Returns: The path to the .git project root
 
     Raises:
         IOError: There is no `.git` folder in the current folder hierarchy
     """
-    working_d = os.getcwd()
+    working_d = working_d or os.getcwd()
+    start_d = working_d
+    own_d = os.path.join(working_d, '.git')
+    cached = ROOT_CACHE.get(start_d)
+    if cached and os.path.exists(cached) and (cached == own_d or not os.path.exists(own_d)):
+        return cached
+
     while working_d != '/':
         git_d = os.path.join(working_d, '.git')
         if os.path.exists(git_d):
+            if len(ROOT_CACHE) > 4096:
+                ROOT_CACHE.clear()
+            ROOT_CACHE[start_d] = git_d
             return git_d
         working_d = os.path.dirname(working_d)
 
@@ -54,13 +137,19 @@ def git_paths(git_root):
     """
     if os.path.isdir(git_root):
         tree_d = git_root
-    else:  # worktree
+    else:  # worktree, submodule or --separate-git-dir
         with open(git_root) as fin:
             tree_d = fin.read().split(": ")[1].strip()
+        # submodules point at their git dir relative to the .git file
+        tree_d = os.path.join(os.path.dirname(git_root), tree_d)
 
         git_root = tree_d
-        while os.path.basename(git_root) != '.git':
-            git_root = os.path.dirname(git_root)
+        try:
+            # worktrees point back at the shared git dir
+            with open(os.path.join(tree_d, 'commondir')) as fin:
+                git_root = os.path.normpath(os.path.join(tree_d, fin.read().strip()))
+        except IOError:
+            pass
 
     stash_file = os.path.join(git_root, 'logs', 'refs', 'stash')
     head_file = os.path.join(tree_d, 'HEAD')
@@ -152,9 +241,213 @@ def parse_stats(lines):
     return staged, conflicts, changed, untracked
 
 
+def parse_branch_headers(headers):
+    """
+    The porcelain v2 equivalent of parse_branch and parse_ahead_behind.
+
+    Args:
+        headers: dict of the `# branch.<key> <value>` header lines by key
+
+    Returns: A tuple of following ...
+        branch: Set to the actual branch name or the hash we are on
+        upstream: Set to the upstream branch if tracked else SYM_NOUPSTREAM
+        local: 1 IFF the branch has no upstream and is not checked out hash
+        ahead: # commits ahead of upstream
+        behind: # commits behind upstream
+    """
+    branch = headers.get('branch.head', '')
+    upstream = headers.get('branch.upstream', SYM_NOUPSTREAM)
+    local = int(upstream == SYM_NOUPSTREAM)
+    if branch == '(detached)':
+        branch = SYM_PREHASH + headers.get('branch.oid', '')[:7]
+        local = 0
+
+    ahead, behind = 0, 0
+    for part in headers.get('branch.ab', '').split():
+        if part[0] == '+':
+            ahead = int(part[1:])
+        elif part[0] == '-':
+            behind = int(part[1:])
+
+    return branch, upstream, local, ahead, behind
+
+
+class StatusCounter(object):
+    """
+    Count git status records as the output streams in, only the record
+    currently being looked at is ever decoded. Understands porcelain v2 with
+    or without -z and porcelain v1 for anything still piping that in.
+
+    With a cap the counter is `done` as soon as every count has either
+    reached the cap or can no longer change. git lists untracked files after
+    all the tracked ones, so the first untracked file settles the others.
+    """
+    V2_STAGED = frozenset(b'ACDMR')
+    V2_CHANGED = frozenset(b'CDMR')
+
+    def __init__(self, cap=MAX_COUNT):
+        self.cap = cap
+        self.done = False
+        self.sep = None
+        self.tail = b''
+        self.headers = {}
+        self.branch_line = None
+        self.skip_orig = False
+        self.staged, self.conflicts, self.changed, self.untracked = 0, 0, 0, 0
+        self.submodules_dirty = 0
+
+    @property
+    def valid(self):
+        """
+        True IFF the stream started like `git status --branch` output, so
+        not e.g. `fatal: not a git repository`
+        """
+        return bool(self.headers) or self.branch_line is not None
+
+    def feed(self, chunk):
+        """
+        Count the complete records in chunk, keeping a partial last record
+        until the next chunk completes it.
+        """
+        data = self.tail + chunk
+        if self.sep is None:
+            nul, newline = data.find(b'\0'), data.find(b'\n')
+            if nul < 0 and newline < 0:
+                self.tail = data
+                return
+            self.sep = b'\0' if nul >= 0 and (newline < 0 or nul < newline) else b'\n'
+        records = data.split(self.sep)
+        self.tail = records.pop()
+        self.count(records)
+        if self.cap:
+            cap = self.cap
+            tracked_done = self.untracked > 0
+            self.done = self.untracked >= cap and all(
+                tracked_done or count >= cap for count in (self.staged, self.conflicts, self.changed))
+
+    def finish(self):
+        if self.tail:
+            self.count([self.tail.rstrip(b'\r\n')])
+            self.tail = b''
+
+    def count(self, records):
+        if self.branch_line is not None or records and records[0][:3] == b'## ':
+            self.count_v1(records)
+            return
+
+        staged_codes, changed_codes = self.V2_STAGED, self.V2_CHANGED
+        for record in records:
+            if self.skip_orig:
+                # the original path of a `2` record is a record of its own with -z
+                self.skip_orig = False
+                continue
+            kind = record[:1]
+            if kind == b'1' or kind == b'2':
+                if record[2] in staged_codes:
+                    self.staged += 1
+                if record[3] in changed_codes:
+                    self.changed += 1
+                self.skip_orig = kind == b'2' and self.sep == b'\0'
+                self.count_submodule(record)
+            elif kind == b'?':
+                self.untracked += 1
+            elif kind == b'u':
+                self.conflicts += 1
+                self.count_submodule(record)
+            elif kind == b'#':
+                key, _, value = record[2:].decode('utf-8', errors='ignore').partition(' ')
+                self.headers[key] = value
+
+    def count_submodule(self, record):
+        # the <sub> field of `1`, `2` and `u` records, `S<c><m><u>` for a submodule
+        # with changes or untracked files
+        if record[5:6] == b'S' and (record[7:8] == b'M' or record[8:9] == b'U'):
+            self.submodules_dirty += 1
+
+    def count_v1(self, records):
+        lines = [record.decode('utf-8', errors='ignore').rstrip() for record in records if record]
+        if self.branch_line is None:
+            self.branch_line = lines.pop(0)
+        stats = parse_stats(lines)
+        self.staged += stats[0]
+        self.conflicts += stats[1]
+        self.changed += stats[2]
+        self.untracked += stats[3]
+
+    def branch(self, head_file):
+        """
+        Returns: (branch, upstream, local, ahead, behind) as parse_branch_headers
+        """
+        if self.branch_line is not None:
+            return (parse_branch(self.branch_line, head_file) +
+                    parse_ahead_behind(self.branch_line))
+        return parse_branch_headers(self.headers)
+
+    def stats(self):
+        """
+        Returns: (# staged, # conflicts, # changed, # untracked), counts that
+            reached the cap are strings like `999+`
+        """
+        return tuple(self.capped(count) for count in
+                     (self.staged, self.conflicts, self.changed, self.untracked))
+
+    def capped(self, count):
+        if self.cap and count >= self.cap:
+            return '{0}+'.format(self.cap)
+        return count
+
+
+def read_status(stream, counter=None):
+    """
+    Feed a git status stream to a StatusCounter a chunk at a time, stopping
+    early once the counter is done.
+
+    Args:
+        stream: A binary file object with the git status output
+        counter: The StatusCounter to feed, a new one if not given
+
+    Returns: The StatusCounter
+    """
+    counter = counter or StatusCounter()
+    while not counter.done:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        counter.feed(chunk)
+    if not counter.done:
+        # after an early stop the tail is a record cut short, not the last one
+        counter.finish()
+
+    return counter
+
+
+def count_lines(path):
+    """
+    Count the lines of a file in CHUNK_SIZE binary reads, a last line
+    without a newline counts too.
+
+    Args:
+        path: The file to count
+
+    Returns: The number of lines
+    """
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as fin:
+        chunk = fin.read(CHUNK_SIZE)
+        while chunk:
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+            chunk = fin.read(CHUNK_SIZE)
+
+    return lines + (last != b'\n')
+
+
 def stash_count(stash_file):
     """
     Determine the number of stashes on the repository by looking at the stash log.
+    The count is cached by cached_load, push appends to the log and drop/pop
+    replace it so an unchanged log is never read again.
 
     Args:
         stash_file: The path to the stash log
@@ -162,8 +455,7 @@ def stash_count(stash_file):
     Returns: The number of stashes
     """
     try:
-        with open(stash_file) as fin:
-            stashes = len(fin.readlines())
+        stashes = cached_load(stash_file, count_lines) or 0
     except IOError:
         stashes = 0
 
@@ -191,64 +483,2105 @@ def rebase_progress(rebase_dir):
     return rebase
 
 
-def current_git_status(lines):
+def current_git_status(counter, cwd=None):
     """
     Parse git status procelain output and return the formatted text that
     represents the current status of the respoistory.
 
+    Args:
+        counter: The StatusCounter fed `git status --porcelain=v2 --branch -z`
+        cwd: The directory git status was run in, defaults to the CWD
+
     Returns: The formatted message representing the git repository
 
     Raises:
         IOError: There is no `.git` folder in the current folder hierarchy
     """
-    git_root = find_git_root()
-    if not os.access(git_root, os.X_OK):
+    git_root = traced('find_git_root', find_git_root, cwd)
+    # .git is a file in worktrees and submodules
+    if not os.access(git_root, os.X_OK if os.path.isdir(git_root) else os.R_OK):
       return '.git not readable'
-    head_file, stash_file, merge_file, rebase_dir = git_paths(git_root)
-    branch, upstream, local = parse_branch(lines[0], head_file)
-    remote = parse_ahead_behind(lines[0])
-    stats = parse_stats(lines[1:])
-    stashes = stash_count(stash_file)
+    head_file, stash_file, merge_file, rebase_dir = traced('git_paths', git_paths, git_root)
+    branch, upstream, local, ahead, behind = counter.branch(head_file)
+    remote = (ahead, behind)
+    stats = counter.stats()
+    stashes = traced('stash_count', stash_count, stash_file)
     merge = int(os.path.isfile(merge_file))
     rebase = rebase_progress(rebase_dir)
     slug = urllib.quote(git_root)
+    submodules = (counter.submodules_dirty, traced('submodules', submodule_drift, git_root)) if SUBMODULES else (0, 0)
 
     values = [str(x) for x in (branch,) + remote + stats +
-              (stashes, local, upstream, merge, rebase, slug)]
+              (stashes, local, upstream, merge, rebase, slug) + submodules]
 
     return ' '.join(values)
 
-def main():
+def read_git_config(config_file):
     """
-    This program can be run two ways:
-        1) `./git-super-status-parser.py`
-            Will wait on subprocess to execute below git status command.
+    Read the settings of a git config file. Handles sections, subsections,
+    comments and quoted values, which is what branch tracking needs.
+    Includes are not followed.
+
+    Args:
+        config_file: The path to the config file
+
+    Returns: dict of `section.subsection.key` to the last value set, section
+        and key are lower cased as git treats them case insensitively
+    """
+    config = {}
+    section = ''
+    try:
+        with open(config_file) as fin:
+            lines = fin.readlines()
+    except IOError:
+        return config
+
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line[0] == '[':
+            header = line[1:line.index(']')] if ']' in line else line[1:]
+            if '"' in header:
+                name, sub_name = header.split('"', 1)
+                section = name.strip().lower() + '.' + sub_name.rsplit('"', 1)[0].replace('\\"', '"')
+            else:
+                section = header.strip().lower()
+            continue
+        key, equals, value = line.partition('=')
+        if not equals:
+            # a bare key is a boolean set to true
+            config[section + '.' + key.strip().lower()] = 'true'
+            continue
+        value = value.strip()
+        if value.startswith('"'):
+            value = value[1:value.rindex('"')] if value.count('"') > 1 else value[1:]
+        else:
+            for mark in '#;':
+                value = value.split(mark, 1)[0]
+            value = value.strip()
+        config[section + '.' + key.strip().lower()] = value
+
+    return config
+
+
+def git_dirs(git_root):
+    """
+    Returns: (the git dir of this worktree, the git dir shared by all worktrees)
+    """
+    head_file, stash_file, _, _ = git_paths(git_root)
+    return os.path.dirname(head_file), os.path.dirname(os.path.dirname(os.path.dirname(stash_file)))
+
+
+def config_upstream(config, branch):
+    """
+    Determine the upstream git status would report for a branch from its
+    `branch.<name>.remote` and `branch.<name>.merge` settings.
+
+    Returns: The upstream like `origin/master` else SYM_NOUPSTREAM
+    """
+    remote = config.get('branch.{0}.remote'.format(branch))
+    merge = config.get('branch.{0}.merge'.format(branch))
+    if not remote or not merge:
+        return SYM_NOUPSTREAM
+    if merge.startswith('refs/heads/'):
+        merge = merge[len('refs/heads/'):]
+
+    return merge if remote == '.' else remote + '/' + merge
+
+
+def cached_load(path, loader):
+    """
+    Load a file through loader once per version of the file, a version is
+    its (mtime, size, inode) so rewrites and replacements are both noticed.
+
+    Args:
+        path: The file to load
+        loader: Called with path to parse the file when it changed
+
+    Returns: What loader returned, None if the file doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        FILE_CACHE.pop(path, None)
+        return None
+    version = (st.st_mtime, st.st_size, st.st_ino)
+    entry = FILE_CACHE.get(path)
+    if entry is None or entry[0] != version:
+        entry = (version, loader(path))
+        FILE_CACHE[path] = entry
+
+    return entry[1]
+
+
+def read_packed_refs(packed_file):
+    """
+    Returns: dict of ref name to hex object id from a packed-refs file
+    """
+    refs = {}
+    with open(packed_file) as fin:
+        for line in fin:
+            if line[0] in '#^':
+                continue
+            parts = line.split()
+            if len(parts) == 2:
+                refs[parts[1]] = parts[0]
+
+    return refs
+
+
+def resolve_ref(tree_d, common_d, ref):
+    """
+    Resolve a ref to the object id it points at, following symbolic refs.
+    Loose refs win over packed-refs just as they do for git.
+
+    Args:
+        tree_d: The git dir of this worktree, where HEAD lives
+        common_d: The git dir shared by all worktrees, where refs live
+        ref: The ref, e.g. HEAD or refs/heads/master
+
+    Returns: The hex object id, None if the ref doesn't exist (e.g. unborn branch)
+    """
+    for _ in range(5):
+        ref_file = os.path.join(tree_d if ref == 'HEAD' else common_d, ref)
+        try:
+            with open(ref_file) as fin:
+                value = fin.read().strip()
+        except IOError:
+            packed = cached_load(os.path.join(common_d, 'packed-refs'), read_packed_refs)
+            return (packed or {}).get(ref)
+        if not value.startswith('ref: '):
+            return value
+        ref = value[len('ref: '):]
+
+    return None
+
+
+def read_varint(data, pos):
+    """
+    Decode one of git's offset varints (varint.c), as used by index v4.
+
+    Returns: (the value, the position after it)
+    """
+    byte = bytearray(data[pos:pos + 1])[0]
+    pos += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = bytearray(data[pos:pos + 1])[0]
+        pos += 1
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, pos
+
+
+def read_index_gitlinks(index_file, paths, oid_len=20):
+    """
+    Find the commits the index records for submodules. In index v2 and v3
+    only the entries with the gitlink mode are decoded, found by searching
+    for the mode bytes and checking the name there is one of paths, v4
+    compresses names against the previous entry so it is walked in full.
+
+    Args:
+        index_file: The path to the index
+        paths: The submodule paths, from .gitmodules
+        oid_len: 20 or 32 for sha256 repositories
+
+    Returns: dict of path to hex object id
+    """
+    with open(index_file, 'rb') as fin:
+        data = fin.read()
+    signature, version, count = struct.unpack('>4sLL', data[:12])
+    if signature != b'DIRC' or version not in (2, 3, 4):
+        return {}
+    wanted = set(path.encode('utf-8') for path in paths)
+    gitlink = struct.pack('>L', 0o160000)
+    gitlinks = {}
+
+    if version < 4:
+        mode_at = data.find(gitlink, 12)
+        while mode_at >= 0:
+            entry_at = mode_at - 24
+            if entry_at < 12 or entry_at + 42 + oid_len > len(data):
+                mode_at = data.find(gitlink, mode_at + 1)
+                continue
+            flags, = struct.unpack_from('>H', data, entry_at + 40 + oid_len)
+            name_at = entry_at + 42 + oid_len + (2 if flags & 0x4000 and version == 3 else 0)
+            name = data[name_at:name_at + (flags & 0xfff)]
+            if name in wanted and data[name_at + len(name):name_at + len(name) + 1] == b'\0':
+                oid = data[entry_at + 40:entry_at + 40 + oid_len]
+                gitlinks[name.decode('utf-8')] = binascii.hexlify(oid).decode('ascii')
+            mode_at = data.find(gitlink, mode_at + 1)
+        return gitlinks
+
+    pos = 12
+    name = b''
+    for _ in range(count):
+        mode = data[pos + 24:pos + 28]
+        oid = data[pos + 40:pos + 40 + oid_len]
+        flags, = struct.unpack_from('>H', data, pos + 40 + oid_len)
+        strip, name_at = read_varint(data, pos + 42 + oid_len + (2 if flags & 0x4000 else 0))
+        end = data.index(b'\0', name_at)
+        name = name[:len(name) - strip] + data[name_at:end]
+        pos = end + 1
+        if mode == gitlink and name in wanted:
+            gitlinks[name.decode('utf-8')] = binascii.hexlify(oid).decode('ascii')
+
+    return gitlinks
+
+
+def oid_length(common_d):
+    """
+    Returns: The length of an object id in bytes, 32 for sha256 repositories else 20
+    """
+    config = cached_load(os.path.join(common_d, 'config'), read_git_config) or {}
+    return 32 if config.get('extensions.objectformat') == 'sha256' else 20
+
+
+def index_gitlinks(git_root):
+    """
+    The gitlinks of the worktree's index for the submodules in .gitmodules,
+    cached until the index or .gitmodules change.
+
+    Returns: dict of submodule path to the hex object id the superproject records
+    """
+    tree_d, common_d = git_dirs(git_root)
+    config = cached_load(os.path.join(os.path.dirname(git_root), '.gitmodules'), read_git_config)
+    if not config:
+        return {}
+    paths = sorted(value for key, value in config.items()
+                   if key.startswith('submodule.') and key.endswith('.path'))
+    index_file = os.path.join(tree_d, 'index')
+    st = os.stat(index_file)
+    version = (st.st_mtime, st.st_size, st.st_ino, tuple(paths))
+    entry = GITLINK_CACHE.get(index_file)
+    if entry is None or entry[0] != version:
+        entry = (version, read_index_gitlinks(index_file, paths, oid_length(common_d)))
+        GITLINK_CACHE[index_file] = entry
+
+    return entry[1]
+
+
+def read_head(head_file):
+    with open(head_file) as fin:
+        return fin.read().strip()
 
-        2) `git status --branch --porcelain | ./git-super-status-parser.py`
-            Will read stdin and parse it.
+
+def submodule_drift(git_root):
+    """
+    Count the checked out submodules whose HEAD is not the commit recorded
+    in the superproject's index, without running git. Each submodule's HEAD
+    goes through cached_load, submodules are usually detached so that is
+    all there is to read.
+
+    Args:
+        git_root: The path to .git of the superproject
+
+    Returns: The number of submodules at another commit
+    """
+    work_d = os.path.dirname(git_root)
+    drift = 0
+    try:
+        gitlinks = index_gitlinks(git_root)
+    except (IOError, OSError, ValueError, struct.error):
+        return 0
+    for path, oid in gitlinks.items():
+        sub_git = os.path.join(work_d, path, '.git')
+        try:
+            head_file = git_paths(sub_git)[0]
+            head = cached_load(head_file, read_head)
+        except (IOError, IndexError):
+            # not checked out
+            continue
+        if head and head.startswith('ref: '):
+            tree_d, common_d = git_dirs(sub_git)
+            head = resolve_ref(tree_d, common_d, head[len('ref: '):])
+        if head and head != oid:
+            drift += 1
+
+    return drift
+
+
+class CommitGraph(object):
+    """
+    One commit-graph file, see gitformat-commit-graph. The file is memory
+    mapped and only the entries a walk touches are ever decoded.
+    """
+    NO_PARENT = 0x70000000
+    EXTRA_EDGES = 0x80000000
+
+    def __init__(self, graph_file):
+        import mmap
+        with open(graph_file, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:4] != b'CGPH':
+            raise ValueError('not a commit-graph: ' + graph_file)
+        # bytearray so the header bytes are ints on python 2 too
+        _, hash_version, chunk_count = bytearray(self.data[4:7])
+        self.hash_len = 32 if hash_version == 2 else 20
+        chunks = {}
+        for i in range(chunk_count + 1):
+            chunk_id, offset = struct.unpack_from('>4sQ', self.data, 8 + 12 * i)
+            chunks[chunk_id] = offset
+        self.fanout = chunks[b'OIDF']
+        self.oids = chunks[b'OIDL']
+        self.commits = chunks[b'CDAT']
+        self.edges = chunks.get(b'EDGE')
+        self.count = struct.unpack_from('>I', self.data, self.fanout + 255 * 4)[0]
+        self.base = 0
+
+    def position(self, oid):
+        """
+        Returns: The position of the binary oid in this file, None if absent
+        """
+        first = bytearray(oid[:1])[0]
+        low = struct.unpack_from('>I', self.data, self.fanout + (first - 1) * 4)[0] if first else 0
+        high = struct.unpack_from('>I', self.data, self.fanout + first * 4)[0]
+        size = self.hash_len
+        while low < high:
+            mid = (low + high) // 2
+            start = self.oids + mid * size
+            found = self.data[start:start + size]
+            if found == oid:
+                return mid
+            if found < oid:
+                low = mid + 1
+            else:
+                high = mid
+
+        return None
+
+    def oid(self, pos):
+        start = self.oids + pos * self.hash_len
+        return self.data[start:start + self.hash_len]
+
+    def commit(self, pos):
+        """
+        Returns: (global positions of the parents, topological level, commit time)
+        """
+        offset = self.commits + pos * (self.hash_len + 16) + self.hash_len
+        parent1, parent2, level_time, time_low = struct.unpack_from('>IIII', self.data, offset)
+        parents = []
+        if parent1 != self.NO_PARENT:
+            parents.append(parent1)
+        if parent2 & self.EXTRA_EDGES:
+            edge = parent2 & ~self.EXTRA_EDGES
+            while True:
+                parent = struct.unpack_from('>I', self.data, self.edges + edge * 4)[0]
+                parents.append(parent & ~self.EXTRA_EDGES)
+                if parent & self.EXTRA_EDGES:
+                    break
+                edge += 1
+        elif parent2 != self.NO_PARENT:
+            parents.append(parent2)
+
+        return parents, level_time >> 2, ((level_time & 3) << 32) | time_low
+
+
+def load_commit_graphs(objects_d):
     """
+    Open the commit-graph of a repository, either the single file or each
+    layer of a split graph chain with positions numbered across layers.
 
-    if not sys.stdin.isatty():
-        lines = [line.rstrip() for line in sys.stdin.readlines()]
-        err = u'\n'.join(lines)
+    Returns: list of CommitGraph, base layer first
+    """
+    info_d = os.path.join(objects_d, 'info')
+    chain_file = os.path.join(info_d, 'commit-graphs', 'commit-graph-chain')
+    if os.path.isfile(chain_file):
+        with open(chain_file) as fin:
+            names = [line.strip() for line in fin if line.strip()]
+        graph_files = [os.path.join(info_d, 'commit-graphs', 'graph-{0}.graph'.format(name))
+                       for name in names]
     else:
-        proc = sub.Popen(['git', 'status', '--branch', '--porcelain'],
-                         stdout=sub.PIPE, stderr=sub.PIPE)
-        out, err = proc.communicate()
-        err = err.decode('utf-8', errors='ignore').strip()
-        lines = out.decode('utf-8', errors='ignore').splitlines()
+        graph_files = [os.path.join(info_d, 'commit-graph')]
+
+    graphs = []
+    base = 0
+    for graph_file in graph_files:
+        if not os.path.isfile(graph_file):
+            break
+        graph = CommitGraph(graph_file)
+        graph.base = base
+        base += graph.count
+        graphs.append(graph)
+
+    return graphs
+
+
+class PackIndex(object):
+    """
+    One version 2 pack .idx file, memory mapped for object lookups.
+    """
+
+    def __init__(self, idx_file):
+        import mmap
+        with open(idx_file, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:8] != b'\xfftOc\x00\x00\x00\x02':
+            raise ValueError('unsupported pack index: ' + idx_file)
+        self.pack_file = idx_file[:-len('.idx')] + '.pack'
+        self.count = struct.unpack_from('>I', self.data, 8 + 255 * 4)[0]
+        self.oids = 8 + 256 * 4
+        self.offsets = self.oids + self.count * 24
+        self.large_offsets = self.offsets + self.count * 4
+
+    def offset(self, oid):
+        """
+        Returns: The offset of the binary oid in the pack, None if absent
+        """
+        first = bytearray(oid[:1])[0]
+        low = struct.unpack_from('>I', self.data, 8 + (first - 1) * 4)[0] if first else 0
+        high = struct.unpack_from('>I', self.data, 8 + first * 4)[0]
+        while low < high:
+            mid = (low + high) // 2
+            found = self.data[self.oids + mid * 20:self.oids + mid * 20 + 20]
+            if found == oid:
+                offset = struct.unpack_from('>I', self.data, self.offsets + mid * 4)[0]
+                if offset & 0x80000000:
+                    index = offset & 0x7fffffff
+                    offset = struct.unpack_from('>Q', self.data, self.large_offsets + index * 8)[0]
+                return offset
+            if found < oid:
+                low = mid + 1
+            else:
+                high = mid
+
+        return None
+
+
+def parse_commit(body):
+    """
+    Returns: (hex ids of the parents, committer time) from a raw commit object
+    """
+    parents, when = [], 0
+    for line in body.split(b'\n'):
+        if not line:
+            break
+        if line.startswith(b'parent '):
+            parents.append(line[7:].decode('ascii'))
+        elif line.startswith(b'committer '):
+            when = int(line.rsplit(b' ', 2)[1])
+
+    return parents, when
+
+
+class CommitReader(object):
+    """
+    Look up the parents of commits without running git. The commit-graph
+    answers for everything it covers, commits newer than the graph are read
+    from loose objects or from packs when stored whole. Deltified commits
+    are not reconstructed, the walk gives up on those instead.
+    """
+    # Commits missing from the graph are newer than everything in it
+    INFINITY = 0xffffffff
+
+    def __init__(self, objects_d):
+        self.objects_d = objects_d
+        self.graphs = load_commit_graphs(objects_d)
+        self.packs = None
+
+    def lookup(self, oid):
+        """
+        Args:
+            oid: A hex object id
+
+        Returns: (hex ids of the parents, topological level, commit time),
+            None when the commit can't be read
+        """
+        binary = binascii.unhexlify(oid)
+        for graph in self.graphs:
+            pos = graph.position(binary)
+            if pos is not None:
+                parents, level, when = graph.commit(pos)
+                return [self.graph_oid(parent) for parent in parents], level, when
+
+        body = self.loose_object(oid) or self.packed_object(binary)
+        if body is None:
+            return None
+        parents, when = parse_commit(body)
+        return parents, self.INFINITY, when
+
+    def graph_oid(self, pos):
+        for graph in self.graphs:
+            if pos < graph.base + graph.count:
+                return binascii.hexlify(graph.oid(pos - graph.base)).decode('ascii')
+        raise ValueError('commit-graph position out of range')
+
+    def loose_object(self, oid):
+        try:
+            with open(os.path.join(self.objects_d, oid[:2], oid[2:]), 'rb') as fin:
+                data = zlib.decompress(fin.read())
+        except (IOError, zlib.error):
+            return None
+        header, _, body = data.partition(b'\0')
+        return body if header.startswith(b'commit ') else None
+
+    def packed_object(self, oid):
+        if self.packs is None:
+            pack_d = os.path.join(self.objects_d, 'pack')
+            try:
+                names = sorted(name for name in os.listdir(pack_d) if name.endswith('.idx'))
+            except OSError:
+                names = []
+            self.packs = [PackIndex(os.path.join(pack_d, name)) for name in names]
+        for pack in self.packs:
+            offset = pack.offset(oid)
+            if offset:
+                with open(pack.pack_file, 'rb') as fin:
+                    fin.seek(offset)
+                    byte = ord(fin.read(1))
+                    # a commit object stored whole is type 1, anything else is a delta
+                    if (byte >> 4) & 7 != 1:
+                        return None
+                    while byte & 0x80:
+                        byte = ord(fin.read(1))
+                    inflater = zlib.decompressobj()
+                    body = b''
+                    # unused_data rather than eof, which python 2 lacks
+                    while not inflater.unused_data:
+                        chunk = fin.read(4096)
+                        if not chunk:
+                            break
+                        body += inflater.decompress(chunk)
+                    return body
+        return None
+
+
+def commit_reader(objects_d):
+    """
+    Returns: The CommitReader for an objects directory, reused until a
+        commit-graph is written or a pack is added or removed
+    """
+    version = []
+    for sub_d in ('info', os.path.join('info', 'commit-graphs'), 'pack'):
+        try:
+            st = os.stat(os.path.join(objects_d, sub_d))
+            version.append((st.st_mtime, st.st_ino))
+        except OSError:
+            version.append(None)
+    entry = FILE_CACHE.get(objects_d)
+    if entry is None or entry[0] != version:
+        entry = (version, CommitReader(objects_d))
+        FILE_CACHE[objects_d] = entry
+
+    return entry[1]
+
+
+def ahead_behind(reader, local_oid, upstream_oid, limit=WALK_LIMIT):
+    """
+    Count the commits only reachable from one side, as git status does for
+    a branch and its upstream. Commits are visited newest generation first,
+    then newest commit time, then in the order they were found like git's
+    date ordered walk. A commit that turns out to be reachable from the
+    other side after it was visited, as commit times that tie allow, is
+    queued again to pass that on to its parents. The walk stops once every
+    queued commit is reachable from both sides and none of them can be a
+    descendant of a commit counted so far, i.e. is older than all of them,
+    then visits WALK_SLOP more like git does in case of clock skew.
+
+    Outside the commit-graph there are no generation numbers and commit
+    times are all there is to go by, so the walk gives up when it finds a
+    parent newer than its child there rather than risk a wrong count.
+
+    Args:
+        reader: The CommitReader for the repository
+        local_oid: The hex id the branch points at
+        upstream_oid: The hex id the upstream points at
+        limit: The most commits to visit before giving up
+
+    Returns: (# commits ahead, # commits behind), None when the walk gave up
+    """
+    local_side, upstream_side = 1, 2
+    both = local_side | upstream_side
+    flags = {local_oid: local_side}
+    flags[upstream_oid] = flags.get(upstream_oid, 0) | upstream_side
+    commits, queue, queued = {}, [], set()
+    found_order = [0]
+
+    def enqueue(oid):
+        if oid not in commits:
+            commits[oid] = reader.lookup(oid)
+            if commits[oid] is None:
+                return False
+        parents, level, when = commits[oid]
+        found_order[0] += 1
+        heapq.heappush(queue, (-level, -when, found_order[0], oid, parents))
+        queued.add(oid)
+        return True
+
+    pending = 0
+    for oid in flags:
+        if not enqueue(oid):
+            return None
+        pending += flags[oid] != both
+
+    visits, slop = 0, WALK_SLOP
+    # the oldest (generation, commit time) counted, only newer commits can reach it
+    floor = None
+    while queue and slop:
+        if pending or floor is not None and (-queue[0][0], -queue[0][1]) >= floor:
+            slop = WALK_SLOP
+        else:
+            slop -= 1
+        if visits >= limit:
+            return None
+        visits += 1
+        level, when, _, oid, parents = heapq.heappop(queue)
+        queued.discard(oid)
+        side = flags[oid]
+        if side != both:
+            pending -= 1
+            floor = min(floor or (-level, -when), (-level, -when))
+        for parent in parents:
+            old = flags.get(parent, 0)
+            new = old | side
+            if new != old:
+                flags[parent] = new
+                if parent in queued:
+                    pending -= new == both
+                else:
+                    if not enqueue(parent):
+                        return None
+                    pending += new != both
+            if -level == CommitReader.INFINITY == commits[parent][1] and commits[parent][2] > -when:
+                # clock skew, commit times can't be trusted to order the walk
+                return None
+
+    ahead = sum(1 for side in flags.values() if side == local_side)
+    behind = sum(1 for side in flags.values() if side == upstream_side)
+    return ahead, behind
+
+
+def native_branch_status(git_root):
+    """
+    Determine the branch fields of the status line from HEAD, the refs,
+    packed-refs, the config and the commit-graph without running git.
+
+    Args:
+        git_root: The path to .git as returned by find_git_root
+
+    Returns: (branch, upstream, local, ahead, behind) as parse_branch_headers,
+        ahead and behind are SYM_UNKNOWN when the commits couldn't be walked
+    """
+    tree_d, common_d = git_dirs(git_root)
+    with open(os.path.join(tree_d, 'HEAD')) as fin:
+        head = fin.read().strip()
+    if not head.startswith('ref: refs/heads/'):
+        return SYM_PREHASH + head[:7], SYM_NOUPSTREAM, 0, 0, 0
+
+    branch = head[len('ref: refs/heads/'):]
+    config = cached_load(os.path.join(common_d, 'config'), read_git_config) or {}
+    upstream = config_upstream(config, branch)
+    if upstream == SYM_NOUPSTREAM:
+        return branch, upstream, 1, 0, 0
+
+    remote = config.get('branch.{0}.remote'.format(branch))
+    merge = config.get('branch.{0}.merge'.format(branch))
+    tracking_ref = merge if remote == '.' else 'refs/remotes/{0}/{1}'.format(remote, upstream[len(remote) + 1:])
+    local_oid = resolve_ref(tree_d, common_d, 'refs/heads/' + branch)
+    upstream_oid = resolve_ref(tree_d, common_d, tracking_ref)
+    if not local_oid or not upstream_oid:
+        # unborn branch or upstream gone, git reports nothing either
+        return branch, upstream, 0, 0, 0
+
+    key = (local_oid, upstream_oid)
+    counts = AHEAD_BEHIND_CACHE.get(key)
+    if counts is None:
+        objects_d = os.path.join(common_d, 'objects')
+        try:
+            counts = ahead_behind(commit_reader(objects_d), local_oid, upstream_oid)
+        except (IOError, ValueError, struct.error):
+            counts = None
+        if counts is None:
+            return branch, upstream, 0, SYM_UNKNOWN, SYM_UNKNOWN
+        AHEAD_BEHIND_CACHE[key] = counts
+
+    return (branch, upstream, 0) + counts
+
+
+def cheap_git_status(cwd=None):
+    """
+    Format the status of the repository from the files under .git alone, no
+    worktree scan and no git process. This is the first line of --two-tier
+    and what is shown when git status is too slow to wait for. The counts
+    that need the scan are reported as SYM_UNKNOWN.
+
+    Args:
+        cwd: The directory to report on, defaults to the CWD
+
+    Returns: The formatted message representing the git repository
+
+    Raises:
+        IOError: There is no `.git` folder in the current folder hierarchy
+    """
+    git_root = traced('find_git_root', find_git_root, cwd)
+    head_file, stash_file, merge_file, rebase_dir = traced('git_paths', git_paths, git_root)
+    branch, upstream, local, ahead, behind = traced('native_branch', native_branch_status, git_root)
+
+    submodules = (SYM_UNKNOWN, traced('submodules', submodule_drift, git_root)) if SUBMODULES else (0, 0)
+
+    values = [str(x) for x in (branch, ahead, behind)] + [SYM_UNKNOWN] * 4 + [str(x) for x in (
+        stash_count(stash_file), local, upstream, int(os.path.isfile(merge_file)),
+        rebase_progress(rebase_dir), urllib.quote(git_root)) + submodules]
+
+    return ' '.join(values)
+
+
+class StatusTimeout(Exception):
+    """
+    git status did not finish in time and was killed.
+    """
 
-    if err.lower().startswith('fatal: not a git repository'):
-        return
 
+def run_git_status(cwd=None, timeout=None):
+    """
+    Run `git status --porcelain=v2 --branch -z` and count its output as it
+    streams in.
+
+    Args:
+        cwd: The directory to run git in, defaults to the CWD
+        timeout: Seconds to wait for git before giving up, None to wait forever
+
+    Returns: (StatusCounter, stripped stderr text)
+
+    Raises:
+        StatusTimeout: git was still running after timeout seconds
+    """
+    # optional locks off so the prompt never takes .git/index.lock from the user
+    env = dict(os.environ, GIT_OPTIONAL_LOCKS='0')
+    proc = sub.Popen(['git', 'status', '--porcelain=v2', '--branch', '-z'],
+                     stdout=sub.PIPE, stderr=sub.PIPE, cwd=cwd, env=env)
+    expired = []
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, lambda: expired.append(proc.kill()))
+        timer.start()
     try:
-        sys.stdout.write(current_git_status(lines))
-        sys.stdout.flush()
-    except OSError:  # pragma: no cover
-        # this can happen if cwd is deleted
-        pass
-    except IOError:  # pragma: no cover
-        pass
+        counter = read_status(proc.stdout)
+        if counter.done:
+            # capped, the rest of the walk would only be thrown away
+            proc.kill()
+        err = proc.stderr.read()
+        proc.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        proc.stdout.close()
+        proc.stderr.close()
+    if expired:
+        raise StatusTimeout()
+
+    return counter, err.decode('utf-8', errors='ignore').strip()
+
+
+def socket_path():
+    """
+    Determine where the per-user daemon listens.
+
+    Returns: ZSH_GIT_PROMPT_SOCKET if set, else a socket in XDG_RUNTIME_DIR
+        falling back to a uid qualified socket in the temp directory
+    """
+    path = os.environ.get('ZSH_GIT_PROMPT_SOCKET')
+    if path:
+        return path
+    runtime_d = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_d and os.path.isdir(runtime_d):
+        return os.path.join(runtime_d, 'git-super-status.sock')
+
+    return '/tmp/git-super-status-{0}.sock'.format(os.getuid())
+
+
+def trace_path():
+    """
+    Determine where phase timings are logged.
+
+    Returns: ZSH_GIT_PROMPT_TRACE_FILE if set, else a log in XDG_RUNTIME_DIR
+        falling back to a uid qualified log in the temp directory
+    """
+    path = os.environ.get('ZSH_GIT_PROMPT_TRACE_FILE')
+    if path:
+        return path
+    runtime_d = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_d and os.path.isdir(runtime_d):
+        return os.path.join(runtime_d, 'git-super-status-trace.log')
+
+    return '/tmp/git-super-status-trace-{0}.log'.format(os.getuid())
+
+
+def trace_start(trace_id):
+    """
+    Start collecting phase timings for this thread, see traced and trace_flush.
+
+    Args:
+        trace_id: Identifies the prompt the timings belong to, empty to not trace
+    """
+    TRACE_LOCAL.id = trace_id
+    TRACE_LOCAL.records = [] if trace_id else None
+
+
+def trace_record(phase, seconds):
+    """
+    Add a phase timing to the records of this thread, dropped unless tracing.
+    """
+    records = getattr(TRACE_LOCAL, 'records', None)
+    if records is not None:
+        records.append((phase, seconds))
+
+
+def traced(phase, func, *args):
+    """
+    Call func(*args) and record how long it took as phase when tracing.
+
+    Returns: What func returned
+    """
+    if getattr(TRACE_LOCAL, 'records', None) is None:
+        return func(*args)
+    start = clock()
+    try:
+        return func(*args)
+    finally:
+        trace_record(phase, clock() - start)
+
+
+def trace_flush(path=None):
+    """
+    Append the records of this thread to the trace log as `id<TAB>phase<TAB>ms`
+    lines, the shell glue appends its own phases to the same log. The log is
+    a ring buffer of the last TRACE_MAX lines, cut back whenever it grows to
+    about four times that, reading only its tail.
+
+    Args:
+        path: The log, defaults to trace_path()
+    """
+    records = getattr(TRACE_LOCAL, 'records', None)
+    TRACE_LOCAL.records = None
+    if not records:
+        return
+    text = ''.join('{0}\t{1}\t{2:.3f}\n'.format(TRACE_LOCAL.id, phase, seconds * 1000)
+                   for phase, seconds in records)
+    try:
+        with open(path or trace_path(), 'a+b') as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            log.write(text.encode('utf-8'))
+            log.flush()
+            # lines are ~30 bytes, a tail of TRACE_MAX_BYTES holds the last TRACE_MAX with room to spare
+            size = os.fstat(log.fileno()).st_size
+            if TRACE_MAX and size > TRACE_MAX_BYTES * 2:
+                log.seek(size - TRACE_MAX_BYTES)
+                lines = log.read().split(b'\n')[1:-1]
+                log.truncate(0)
+                log.write(b''.join(line + b'\n' for line in lines[-TRACE_MAX:]))
+    except (OSError, IOError):
+        pass
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    rank = max(int(-(-len(values) * pct // 100)), 1)
+    return values[rank - 1]
+
+
+def print_timings(prompts, path=None):
+    """
+    Print p50/p95/p99 per phase over the last prompts found in the trace log.
+
+    Args:
+        prompts: How many of the most recent prompts to report on
+        path: The log, defaults to trace_path()
+    """
+    try:
+        with open(path or trace_path()) as log:
+            lines = log.readlines()
+    except (OSError, IOError):
+        lines = []
+
+    # the daemon's and the shell's lines for a prompt interleave, so prompts are
+    # ordered by where their last line is
+    last_seen = {}
+    records = []
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 3:
+            continue
+        try:
+            records.append((fields[0], fields[1], float(fields[2])))
+        except ValueError:
+            continue
+        last_seen[fields[0]] = len(records)
+    keep = set(sorted(last_seen, key=last_seen.get)[-prompts:])
+
+    phases = {}
+    order = []
+    for trace_id, phase, ms in records:
+        if trace_id in keep:
+            if phase not in phases:
+                phases[phase] = []
+                order.append(phase)
+            phases[phase].append(ms)
+
+    if not order:
+        sys.stdout.write('no timings in {0}, set ZSH_GIT_PROMPT_TRACE=1\n'.format(path or trace_path()))
+        return
+    sys.stdout.write('{0:<16} {1:>6} {2:>9} {3:>9} {4:>9}   ms over the last {5} prompts\n'.format(
+        'phase', 'count', 'p50', 'p95', 'p99', len(keep)))
+    for phase in order:
+        values = sorted(phases[phase])
+        sys.stdout.write('{0:<16} {1:>6} {2:>9.2f} {3:>9.2f} {4:>9.2f}\n'.format(
+            phase, len(values), percentile(values, 50), percentile(values, 95), percentile(values, 99)))
+
+
+def tracking_ref_files(tree_d, common_d):
+    """
+    The loose ref files of the checked out branch and of its upstream, a push
+    only moves the upstream's e.g. refs/remotes/origin/master and a commit the
+    branch's, neither shows in the mtime of refs/heads when the branch name
+    has a `/` in it.
+
+    Returns: A list of paths, empty when HEAD is detached
+    """
+    try:
+        head = cached_load(os.path.join(tree_d, 'HEAD'), read_head)
+    except IOError:
+        return []
+    if not head or not head.startswith('ref: refs/heads/'):
+        return []
+    ref = head[len('ref: '):]
+    files = [os.path.join(common_d, ref)]
+    config = cached_load(os.path.join(common_d, 'config'), read_git_config) or {}
+    branch = ref[len('refs/heads/'):]
+    remote = config.get('branch.{0}.remote'.format(branch))
+    upstream = config_upstream(config, branch)
+    if upstream != SYM_NOUPSTREAM:
+        upstream_ref = 'refs/heads/' + upstream if remote == '.' else 'refs/remotes/' + upstream
+        files.append(os.path.join(common_d, upstream_ref))
+    return files
+
+
+def submodule_head_files(git_root):
+    """
+    The HEAD and HEAD reflog of every submodule in the index, the worktree
+    watch doesn't see them, they live in the superproject's .git/modules.
+
+    Returns: A list of paths
+    """
+    work_d = os.path.dirname(git_root)
+    files = [os.path.join(work_d, '.gitmodules')]
+    try:
+        gitlinks = index_gitlinks(git_root)
+    except (IOError, OSError, ValueError, struct.error):
+        return files
+    for path in sorted(gitlinks):
+        try:
+            head_file = git_paths(os.path.join(work_d, path, '.git'))[0]
+        except (IOError, IndexError):
+            # not checked out
+            continue
+        files.extend((head_file, os.path.join(os.path.dirname(head_file), 'logs', 'HEAD')))
+    return files
+
+
+def state_signature(git_root):
+    """
+    Collect the mtimes of the files under .git that change with the repository
+    state (index, HEAD and its reflog, the branch and upstream refs, stash,
+    merge and rebase) plus the worktree root, and with ZSH_GIT_PROMPT_SUBMODULES
+    the submodules' HEADs.
+
+    Args:
+        git_root: The path to .git as returned by find_git_root
+
+    Returns: A tuple that compares equal IFF none of those paths changed
+    """
+    head_file, stash_file, merge_file, rebase_dir = git_paths(git_root)
+    tree_d, common_d = git_dirs(git_root)
+    paths = [os.path.dirname(git_root), os.path.join(tree_d, 'index'), head_file,
+             os.path.join(tree_d, 'logs', 'HEAD'),
+             os.path.join(common_d, 'refs', 'heads'), os.path.join(common_d, 'packed-refs'),
+             os.path.join(common_d, 'FETCH_HEAD'), stash_file, merge_file, rebase_dir]
+    paths.extend(tracking_ref_files(tree_d, common_d))
+    if SUBMODULES:
+        paths.extend(submodule_head_files(git_root))
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime, st.st_size, st.st_ino))
+        except OSError:
+            signature.append(None)
+
+    return tuple(signature)
+
+
+class InotifyWatcher(object):
+    """
+    Watch repository worktrees through the Linux inotify API so the cache can
+    tell that nothing changed without walking the tree. Directories named
+    `.git` are not watched, state_signature covers those.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.lock = threading.Lock()
+        self.wd_paths = {}
+        self.wd_roots = {}
+        self.root_wds = {}
+        self.ready = set()
+        self.changed = set()
+
+    def add_tree(self, root, top):
+        """
+        Add watches for top and every directory below it, outside `.git`.
+
+        Returns: False when INOTIFY_MAX or the kernel watch limit was hit
+        """
+        for dir_d, subdirs, _ in os.walk(top):
+            subdirs[:] = [sub_d for sub_d in subdirs if sub_d != '.git']
+            with self.lock:
+                if root not in self.root_wds:
+                    # unwatched while walking
+                    return True
+                if len(self.root_wds[root]) >= INOTIFY_MAX:
+                    return False
+                wd = self.libc.inotify_add_watch(self.fd, fs_encode(dir_d), self.MASK)
+                if wd < 0:
+                    if self.ctypes.get_errno() == errno.ENOSPC:
+                        return False
+                    # vanished or unreadable, nothing to see there
+                    continue
+                self.wd_paths[wd] = dir_d
+                self.wd_roots[wd] = root
+                self.root_wds[root].add(wd)
+        return True
+
+    def watch(self, root):
+        """
+        Start watching the worktree at root in a background thread, the root
+        counts as watched once every directory has its watch.
+        """
+        with self.lock:
+            if root in self.root_wds:
+                return
+            self.root_wds[root] = set()
+
+        def add_all():
+            if self.add_tree(root, root):
+                with self.lock:
+                    if root in self.root_wds:
+                        self.ready.add(root)
+            else:
+                self.unwatch(root)
+                with self.lock:
+                    # remember the root so it isn't walked again on every prompt
+                    self.root_wds[root] = set()
+
+        thread = threading.Thread(target=add_all)
+        thread.daemon = True
+        thread.start()
+
+    def unwatch(self, root):
+        with self.lock:
+            for wd in self.root_wds.pop(root, ()):
+                self.wd_paths.pop(wd, None)
+                self.wd_roots.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+            self.ready.discard(root)
+
+    def watching(self, root):
+        with self.lock:
+            return root in self.ready
+
+    def changed_roots(self):
+        """
+        Drain the pending events, watching new directories as they show up.
+        A moved directory makes the paths below it stale so its root is
+        walked again from scratch.
+
+        Returns: The set of roots with changes since the last call
+        """
+        new_dirs, moved = [], set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not buf:
+                break
+            offset = 0
+            with self.lock:
+                while offset < len(buf):
+                    wd, mask, _, length = self.EVENT.unpack_from(buf, offset)
+                    name = buf[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+                    offset += self.EVENT.size + length
+                    if mask & self.IN_Q_OVERFLOW:
+                        self.changed.update(self.root_wds)
+                        continue
+                    root = self.wd_roots.get(wd)
+                    if root is None:
+                        continue
+                    self.changed.add(root)
+                    if mask & self.IN_IGNORED:
+                        self.wd_paths.pop(wd, None)
+                        self.wd_roots.pop(wd, None)
+                        self.root_wds.get(root, set()).discard(wd)
+                    elif mask & self.IN_ISDIR and mask & (self.IN_MOVED_FROM | self.IN_MOVED_TO):
+                        moved.add(root)
+                    elif mask & self.IN_ISDIR and mask & self.IN_CREATE and name != b'.git':
+                        new_dirs.append((root, os.path.join(self.wd_paths[wd], fs_decode(name))))
+
+        for root, new_d in new_dirs:
+            if root not in moved and not self.add_tree(root, new_d):
+                moved.add(root)
+        for root in moved:
+            self.unwatch(root)
+            self.watch(root)
+
+        with self.lock:
+            changed, self.changed = self.changed, set()
+        return changed
+
+
+class IndexStat(object):
+    """
+    The stat data the index records for each tracked file, kept in flat
+    arrays so a large index costs little memory in the daemon. Together with
+    the mtimes of the worktree directories taken after a clean git status it
+    tells whether the tree is still exactly as clean as it was: a tracked
+    file that was edited, replaced, removed or chmod'ed no longer matches its
+    entry and a file or directory created or removed changes the mtime of
+    its directory. The index's untracked cache and fsmonitor extensions are
+    not decoded, the directory mtimes are the same information.
+
+    What the directory mtimes can't see is a file added to an existing
+    directory that only held ignored files, so a clean status is not served
+    this way for more than CLEAN_MAX seconds after git status last ran.
+    """
+    MASK = 0xffffffff
+
+    def __init__(self, index_file, work_d, oid_len=20):
+        with open(index_file, 'rb') as fin:
+            data = fin.read()
+            self.index_mtime_ns = mtime_ns(os.fstat(fin.fileno()))
+        signature, version, count = struct.unpack('>4sLL', data[:12])
+        if signature != b'DIRC' or version not in (2, 3, 4):
+            raise ValueError('unsupported index')
+        self.work_d = work_d
+        self.paths = []
+        self.modes = array.array('L')
+        self.mtimes = array.array('L')
+        self.mtimes_ns = array.array('L')
+        self.sizes = array.array('L')
+        self.inodes = array.array('L')
+        dirs = set([''])
+
+        pos = 12
+        name = b''
+        for _ in range(count):
+            _, _, mtime, mtime_part, _, ino, mode, _, _, size = struct.unpack_from('>10L', data, pos)
+            flags, = struct.unpack_from('>H', data, pos + 40 + oid_len)
+            name_at = pos + 42 + oid_len
+            extended = 0
+            if flags & 0x4000 and version >= 3:
+                extended, = struct.unpack_from('>H', data, name_at)
+                name_at += 2
+            if version == 4:
+                strip, name_at = read_varint(data, name_at)
+                end = data.index(b'\0', name_at)
+                name = name[:len(name) - strip] + data[name_at:end]
+                pos = end + 1
+            else:
+                end = data.index(b'\0', name_at)
+                name = data[name_at:end]
+                pos += (end - pos + 8) & ~7
+            # skip-worktree and intent-to-add entries and submodules aren't stat'ed by git either
+            if extended & 0x6000 or mode & 0o170000 == 0o160000 or flags & 0x3000:
+                continue
+            path = fs_decode(name)
+            self.paths.append(os.path.join(work_d, path))
+            self.modes.append(mode)
+            self.mtimes.append(mtime)
+            self.mtimes_ns.append(mtime_part)
+            self.sizes.append(size)
+            self.inodes.append(ino)
+            parent = os.path.dirname(path)
+            while parent not in dirs:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        self.dirs = [os.path.join(work_d, dir_d) for dir_d in sorted(dirs)]
+
+    def files_unchanged(self):
+        """
+        Returns: True IFF every tracked file still matches its index entry
+            and none of them is racily clean, i.e. as new as the index
+        """
+        mask = self.MASK
+        index_mtime_ns = self.index_mtime_ns
+        modes, mtimes, mtimes_ns, sizes, inodes = self.modes, self.mtimes, self.mtimes_ns, self.sizes, self.inodes
+        lstat = os.lstat
+        for i, path in enumerate(self.paths):
+            try:
+                st = lstat(path)
+            except OSError:
+                return False
+            file_mtime_ns = mtime_ns(st)
+            seconds, part = divmod(file_mtime_ns, 1000000000)
+            if (seconds & mask != mtimes[i] or (mtimes_ns[i] and part != mtimes_ns[i]) or
+                    st.st_size & mask != sizes[i] or st.st_ino & mask != inodes[i] or
+                    file_mtime_ns >= index_mtime_ns):
+                return False
+            mode = modes[i]
+            if stat.S_IFMT(st.st_mode) != mode & 0o170000 or \
+                    stat.S_ISREG(st.st_mode) and bool(st.st_mode & 0o100) != bool(mode & 0o100):
+                return False
+
+        return True
+
+    def dir_mtimes(self):
+        """
+        The mtimes of the directories holding tracked files and of the empty
+        directories in them, a new file in an empty directory makes it show.
+
+        Returns: dict of directory to mtime
+        """
+        mtimes = {}
+        for dir_d in self.dirs:
+            try:
+                mtimes[dir_d] = mtime_ns(os.stat(dir_d))
+                names = os.listdir(dir_d)
+            except OSError:
+                continue
+            for name in names:
+                sub_d = os.path.join(dir_d, name)
+                try:
+                    if sub_d not in mtimes and os.path.isdir(sub_d) and not os.path.islink(sub_d) \
+                            and not os.listdir(sub_d):
+                        mtimes[sub_d] = mtime_ns(os.stat(sub_d))
+                except OSError:
+                    pass
+
+        return mtimes
+
+    @staticmethod
+    def dirs_unchanged(mtimes):
+        for dir_d, dir_mtime in mtimes.items():
+            try:
+                if mtime_ns(os.stat(dir_d)) != dir_mtime:
+                    return False
+            except OSError:
+                return False
+
+        return True
+
+
+def fs_encode(path):
+    """
+    Returns: The path as bytes for the OS, python 2 paths already are
+    """
+    return path.encode('utf-8', 'surrogateescape') if sys.version_info[0] > 2 else path
+
+
+def fs_decode(name):
+    """
+    Returns: A path from the OS as a str, undecodable bytes kept as surrogates
+    """
+    return name.decode('utf-8', 'surrogateescape') if sys.version_info[0] > 2 else name
+
+
+def mtime_ns(st):
+    """
+    Returns: The mtime of a stat result in nanoseconds
+    """
+    return getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+
+
+def status_clean(line):
+    """
+    Returns: True IFF the status line has nothing staged, changed, conflicted or untracked
+    """
+    record = status_record(line)
+    return bool(record) and all(record[key] == 0 for key in
+                                ('staged', 'conflicts', 'changed', 'untracked', 'sub_dirty'))
+
+
+class StatusCache(object):
+    """
+    The daemon's status lines keyed by the root from find_git_root. An entry
+    is served until inotify reports a change in its worktree or its
+    state_signature changes. Without inotify entries also expire after
+    CACHE_TTL seconds since worktree edits can't be seen through mtimes.
+    """
+
+    def __init__(self, watcher=None):
+        self.watcher = watcher
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.clean = {}
+
+    def invalidate(self):
+        if self.watcher:
+            changed = self.watcher.changed_roots()
+            with self.lock:
+                # the watcher reports worktrees, entries are keyed by their .git
+                for work_d in changed:
+                    self.entries.pop(os.path.join(work_d, '.git'), None)
+
+    def lookup(self, git_root):
+        """
+        Returns: (the cached line or None, the signature to store a fresh line with)
+        """
+        self.invalidate()
+        work_d = os.path.dirname(git_root)
+        signature = (state_signature(git_root),
+                     bool(self.watcher and self.watcher.watching(work_d)))
+        with self.lock:
+            entry = self.entries.get(git_root)
+        if entry and entry[0] == signature:
+            if signature[1] or time.time() - entry[1] < CACHE_TTL:
+                return entry[2], signature
+
+        return None, signature
+
+    def release(self, git_root):
+        """
+        Nothing is held between lookup and store, see SharedStatusCache.
+        """
+
+    def verified_clean(self, git_root, signature):
+        """
+        Serve the last status of a clean tree again when the IndexStat check
+        finds the tree untouched, without running git status.
+
+        Returns: The clean status line or None when git status has to run
+        """
+        with self.lock:
+            entry = self.clean.get(git_root)
+        if not entry or entry[0] != signature[0] or time.time() - entry[1] > CLEAN_MAX:
+            return None
+        _, _, index_stat, dir_mtimes, line = entry
+        if index_stat.files_unchanged() and index_stat.dirs_unchanged(dir_mtimes):
+            return line
+        with self.lock:
+            self.clean.pop(git_root, None)
+        return None
+
+    def store_clean(self, git_root, signature, line):
+        """
+        Remember a clean status from git status for verified_clean, the
+        index is parsed again only when it changed.
+        """
+        if not CLEAN_MAX or not status_clean(line):
+            with self.lock:
+                self.clean.pop(git_root, None)
+            return
+        tree_d, common_d = git_dirs(git_root)
+        index_file = os.path.join(tree_d, 'index')
+        with self.lock:
+            entry = self.clean.get(git_root)
+        try:
+            if entry and entry[0] == signature[0]:
+                index_stat = entry[2]
+            else:
+                index_stat = IndexStat(index_file, os.path.dirname(git_root), oid_length(common_d))
+            entry = (signature[0], time.time(), index_stat, index_stat.dir_mtimes(), line)
+        except (IOError, OSError, ValueError, struct.error):
+            return
+        with self.lock:
+            self.clean[git_root] = entry
+            for old_root in list(self.clean)[:-CACHE_MAX_ROOTS]:
+                del self.clean[old_root]
+
+    def store(self, git_root, signature, line):
+        if not signature[1] and not CACHE_TTL:
+            return
+        work_d = os.path.dirname(git_root)
+        with self.lock:
+            self.entries.pop(git_root, None)
+            self.entries[git_root] = (signature, time.time(), line)
+            evicted = list(self.entries)[:-CACHE_MAX_ROOTS]
+            for old_root in evicted:
+                del self.entries[old_root]
+        if self.watcher:
+            for old_root in evicted:
+                self.watcher.unwatch(os.path.dirname(old_root))
+            self.watcher.watch(work_d)
+
+
+def make_status_cache():
+    """
+    Returns: A StatusCache backed by inotify where the platform allows it
+    """
+    watcher = None
+    if INOTIFY_MAX and sys.platform.startswith('linux'):
+        try:
+            watcher = InotifyWatcher()
+        except (OSError, AttributeError):
+            watcher = None
+
+    return StatusCache(watcher)
+
+
+def cache_dir():
+    """
+    Determine where SharedStatusCache keeps its files.
+
+    Returns: ZSH_GIT_PROMPT_CACHE_DIR if set, else a directory in XDG_RUNTIME_DIR
+        falling back to a uid qualified directory in the temp directory
+    """
+    path = os.environ.get('ZSH_GIT_PROMPT_CACHE_DIR')
+    if path:
+        return path
+    runtime_d = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_d and os.path.isdir(runtime_d):
+        return os.path.join(runtime_d, 'git-super-status', 'cache')
+
+    return '/tmp/git-super-status-{0}/cache'.format(os.getuid())
+
+
+class SharedStatusCache(object):
+    """
+    Status lines shared by every shell of the user through one small file per
+    root in cache_dir(), XDG_RUNTIME_DIR is a tmpfs so they stay in memory.
+    An entry is served while its state_signature matches and it is younger
+    than CACHE_TTL seconds, worktree edits are only seen once it expires.
+
+    A miss takes an flock on the root's lock file before git status runs, so
+    terminals prompting in the same repository at once wait for the first one
+    and reuse its line instead of all walking the worktree. The lock is given
+    up by store or release, or when the process exits.
+    """
+
+    def __init__(self, path=None, wait=SHARED_WAIT):
+        self.path = path or cache_dir()
+        self.wait = wait
+        self.held = {}
+
+    def entry_path(self, git_root):
+        name = hashlib.sha1(git_root.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name)
+
+    def usable(self):
+        """
+        Returns: True IFF the cache directory exists, or could be made, and only we can write it
+        """
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                return False
+        st = os.lstat(self.path)
+        return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+    def read(self, git_root, signature):
+        try:
+            with open(self.entry_path(git_root)) as fin:
+                entry = json.load(fin)
+        except (IOError, ValueError):
+            return None
+        if entry.get('root') == git_root and entry.get('signature') == signature and \
+                0 <= time.time() - entry.get('time', 0) < CACHE_TTL:
+            return entry.get('line')
+        return None
+
+    def lock(self, git_root):
+        """
+        Wait up to self.wait seconds for the lock on git_root, carrying on
+        without it when a stuck terminal holds it longer.
+        """
+        try:
+            lock_file = open(self.entry_path(git_root) + '.lock', 'a')
+        except IOError:
+            return
+        give_up = time.time() + self.wait
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.held[git_root] = lock_file
+                return
+            except (IOError, OSError) as ex:
+                if ex.errno not in (errno.EAGAIN, errno.EACCES) or time.time() > give_up:
+                    lock_file.close()
+                    return
+            time.sleep(0.02)
+
+    def lookup(self, git_root):
+        """
+        Returns: (the cached line or None, the signature to store a fresh line with),
+            on None the caller holds the lock until store or release
+        """
+        if not CACHE_TTL or not self.usable():
+            return None, None
+        # through json so it compares equal to what read loads
+        signature = json.loads(json.dumps(state_signature(git_root)))
+        line = self.read(git_root, signature)
+        if line is None:
+            self.lock(git_root)
+            # whoever held the lock may have just stored it
+            line = self.read(git_root, signature)
+            if line is not None:
+                self.release(git_root)
+
+        return line, signature
+
+    def verified_clean(self, git_root, signature):
+        """
+        Not done here, each process would parse the index anew, see StatusCache.
+        """
+        return None
+
+    def store_clean(self, git_root, signature, line):
+        pass
+
+    def release(self, git_root):
+        lock_file = self.held.pop(git_root, None)
+        if lock_file:
+            lock_file.close()
+
+    def store(self, git_root, signature, line):
+        if signature is None:
+            return
+        path = self.entry_path(git_root)
+        temp = '{0}.{1}'.format(path, os.getpid())
+        try:
+            with open(temp, 'w') as fout:
+                json.dump({'root': git_root, 'signature': signature, 'time': time.time(), 'line': line}, fout)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            pass
+        finally:
+            self.release(git_root)
+
+
+def seed_git_root(cwd, root):
+    """
+    Let find_git_root start from the worktree root the shell already knows
+    for cwd, ignored unless cwd is inside root.
+    """
+    if root and (cwd + '/').startswith(root.rstrip('/') + '/'):
+        ROOT_CACHE[cwd] = os.path.join(root, '.git')
+
+
+def directory_status(cwd, cache=None, timeout=None):
+    """
+    Compute the status line for a directory, as the one-shot mode would print it.
+
+    Args:
+        cwd: The directory to report on
+        cache: A StatusCache or SharedStatusCache to serve unchanged repositories from
+        timeout: Seconds to wait for git status before falling back to cheap_git_status
+
+    Returns: The formatted message, empty when cwd is not in a repository
+    """
+    git_root = None
+    try:
+        if cache:
+            git_root = find_git_root(cwd)
+            line, signature = traced('cache_lookup', cache.lookup, git_root)
+            if line is None:
+                line = traced('clean_check', cache.verified_clean, git_root, signature)
+                if line is not None:
+                    cache.store(git_root, signature, line)
+            if line is not None:
+                return line
+        try:
+            counter, err = traced('git_status', run_git_status, cwd, timeout)
+        except StatusTimeout:
+            return cheap_git_status(cwd)
+        if err.lower().startswith('fatal: not a git repository') or not counter.valid:
+            return ''
+        line = current_git_status(counter, cwd)
+        if cache:
+            cache.store(git_root, signature, line)
+            traced('clean_store', cache.store_clean, git_root, signature, line)
+        return line
+    except (OSError, IOError):
+        # cwd was deleted or isn't in a repository
+        return ''
+    finally:
+        if cache and git_root:
+            cache.release(git_root)
+
+
+def status_record(line):
+    """
+    Turn a status line into a dict keyed by STATUS_FIELDS, the numbers that
+    were counted become ints and root is the decoded worktree path.
+
+    Args:
+        line: A line as made by current_git_status or cheap_git_status
+
+    Returns: The record, empty if line isn't a status line
+    """
+    values = line.split(' ')
+    if len(values) != len(STATUS_FIELDS):
+        return {}
+    record = dict(zip(STATUS_FIELDS, values))
+    for key in ('ahead', 'behind', 'staged', 'conflicts', 'changed', 'untracked', 'stashes', 'local', 'merge',
+                'sub_dirty', 'sub_commit'):
+        if record[key].isdigit():
+            record[key] = int(record[key])
+    record['root'] = os.path.dirname(urllib.unquote(record['root']))
+
+    return record
+
+
+def zsh_quote(value):
+    """
+    Quote a value for zsh, words that need no quoting are left bare. A
+    leading `=` or `~` is always quoted, zsh would expand it.
+    """
+    value = str(value)
+    if value and value[0] not in '=~' and all(char.isalnum() or char in '%+,-./:=@_' for char in value):
+        return value
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def format_status(line, fmt='line'):
+    """
+    Render a status line in one of the --format output formats:
+        line: The line as is, space separated STATUS_FIELDS
+        zsh-assoc: `typeset -gA GIT_STATUS; GIT_STATUS=( key value ... )` to eval
+        json: The status_record as a json object
+
+    Args:
+        line: A line as made by current_git_status or cheap_git_status
+        fmt: The format name
+
+    Returns: The rendered status, empty when line is
+    """
+    if fmt == 'line' or not line:
+        return line
+    record = status_record(line)
+    if fmt == 'json':
+        return json.dumps(record or {'error': line}, sort_keys=True)
+    if not record:
+        return ''
+    return 'typeset -gA GIT_STATUS; GIT_STATUS=( {0} )'.format(
+        ' '.join(zsh_quote(key) + ' ' + zsh_quote(record[key]) for key in STATUS_FIELDS))
+
+
+def find_repos(top_d):
+    """
+    Find the repositories below a directory. A directory with a `.git` that
+    git_paths resolves to a HEAD is a repository, so worktrees and submodule
+    checkouts count. Inside a worktree only the paths to the submodules in
+    its .gitmodules are searched, the rest of it, build outputs and vendored
+    trees included, is left alone.
+
+    Args:
+        top_d: The directory to search
+
+    Yields: The worktree directories, in walk order
+    """
+    # directory to the names below it on the way to a submodule
+    wanted = {}
+    for dir_d, sub_ds, file_names in os.walk(top_d):
+        if '.git' in sub_ds or '.git' in file_names:
+            try:
+                is_repo = os.path.isfile(git_paths(os.path.join(dir_d, '.git'))[0])
+            except (IOError, IndexError):
+                is_repo = False
+            if is_repo:
+                yield dir_d
+                wanted.setdefault(dir_d, set())
+                config = cached_load(os.path.join(dir_d, '.gitmodules'), read_git_config) or {}
+                for key, value in config.items():
+                    if key.startswith('submodule.') and key.endswith('.path'):
+                        parent_d = dir_d
+                        for name in value.strip('/').split('/'):
+                            wanted.setdefault(parent_d, set()).add(name)
+                            parent_d = os.path.join(parent_d, name)
+                        # nothing below it unless it turns out to be a repository
+                        wanted.setdefault(parent_d, set())
+        sub_ds[:] = sorted(sub_d for sub_d in sub_ds if sub_d != '.git' and
+                           (dir_d not in wanted or sub_d in wanted[dir_d]))
+
+
+def scan_status(job):
+    """
+    Compute the status record of one repository for --scan, runs in a pool process.
+
+    Args:
+        job: (worktree directory, seconds to wait for git status)
+
+    Returns: The status_record of the repository plus its `path`, `timeout`
+        is set when git status was given up on and the counts are SYM_UNKNOWN,
+        `error` when there was no status to report
+    """
+    repo_d, timeout = job
+    record = {'path': repo_d}
+    try:
+        try:
+            counter, err = run_git_status(repo_d, timeout)
+            line = current_git_status(counter, repo_d) if counter.valid else err
+        except StatusTimeout:
+            line = cheap_git_status(repo_d)
+            record['timeout'] = True
+    except (OSError, IOError) as ex:
+        line = str(ex)
+    fields = status_record(line)
+    if fields:
+        record.update(fields)
+    else:
+        record['error'] = line or 'no status'
+
+    return record
+
+
+def scan(top_d, jobs=None, timeout=None, out=sys.stdout):
+    """
+    Write the status of every repository below a directory as NDJSON, one
+    line per repository in the order they finish.
+
+    Args:
+        top_d: The directory to search, see find_repos
+        jobs: How many repositories are worked on at once, defaults to the CPU count
+        timeout: Seconds each git status gets, see scan_status
+        out: Where the lines go
+    """
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+    try:
+        repos = ((repo_d, timeout) for repo_d in find_repos(os.path.abspath(top_d)))
+        for record in pool.imap_unordered(scan_status, repos):
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+            out.flush()
+    except IOError:
+        # the reader went away
+        pass
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def load_util():
+    """
+    Load git-super-status-util.py from next to this file once, its name
+    isn't importable as is.
+
+    Returns: The util module
+    """
+    global UTIL
+    if UTIL is None:
+        try:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location('git_super_status_util', UTIL_FILE)
+            UTIL = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(UTIL)
+        except ImportError:
+            import imp
+            UTIL = imp.load_source('git_super_status_util', UTIL_FILE)
+    return UTIL
+
+
+def strip_prompt(template):
+    """
+    Remove the zsh prompt escapes from template, memoized by the util so the
+    theme strings are only stripped the first time they come by.
+    """
+    return load_util().strip_prompt(template)
+
+
+class StatusRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serve one request per connection. The request is a single line holding
+    the absolute directory to report on, optionally followed by tab separated
+    key=value options (timeout=SECONDS, cheap=1, root=WORKTREE, trace=ID,
+    format=NAME see format_status), the reply is the status
+    followed by a newline. Lines starting with `!` are control requests.
+
+    `!batch` (options skip-zeros=1, diff=1, begin=MARK, end=MARK) is followed
+    by `p<TAB>line` lines of the previous status block, `r<TAB>record` lines
+    as for `git-super-status-util.py batch` and an empty line, the reply is
+    what that batch call prints so the prompt's status block is stripped by
+    a warm memo without starting an interpreter.
+    """
+
+    def handle(self):
+        request = self.rfile.readline().decode('utf-8', errors='ignore').rstrip('\n')
+        fields = request.split('\t')
+        request = fields[0]
+        options = dict(field.split('=', 1) for field in fields[1:] if '=' in field)
+        if request == '!quit':
+            reply = 'bye'
+            self.server.done = True
+        elif request == '!ping':
+            reply = 'pong {0}'.format(os.getpid())
+        elif request == '!batch':
+            previous, records = [], []
+            for line in iter(self.rfile.readline, b''):
+                line = line.decode('utf-8', errors='ignore').rstrip('\n')
+                if not line:
+                    break
+                kind, _, text = line.partition('\t')
+                (previous if kind == 'p' else records).append(text)
+            reply = load_util().batch(records, options.get('skip-zeros') == '1',
+                                      '\n'.join(previous) if options.get('diff') == '1' else None,
+                                      options.get('begin', ''), options.get('end', ''))
+        elif request.startswith('/'):
+            timeout = float(options['timeout']) if options.get('timeout') else None
+            seed_git_root(request, options.get('root'))
+            trace_start(options.get('trace'))
+            start = clock()
+            if options.get('cheap') == '1':
+                try:
+                    reply = cheap_git_status(request)
+                except (OSError, IOError):
+                    reply = ''
+            else:
+                reply = directory_status(request, self.server.cache, timeout)
+            reply = format_status(reply, options.get('format', 'line'))
+            trace_record('daemon', clock() - start)
+            trace_flush()
+        else:
+            reply = ''
+        self.wfile.write((reply + '\n').encode('utf-8'))
+
+
+class StatusServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    The per-user status daemon, keeps an interpreter warm so a prompt only
+    pays for a socket round trip and the git status walk.
+    """
+    daemon_threads = True
+    done = False
+    cache = None
+    # How often the idle/quit checks run while waiting for requests
+    timeout = 0.5
+    last_request = 0
+
+    def process_request(self, request, client_address):
+        self.last_request = time.time()
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def idle(self):
+        return DAEMON_IDLE and time.time() - self.last_request > DAEMON_IDLE
+
+
+def daemon_running(path):
+    """
+    Check if a daemon is accepting connections on path.
+
+    Returns: True IFF something answered on the socket
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        return True
+    except (OSError, IOError):
+        return False
+    finally:
+        client.close()
+
+
+def serve(path):
+    """
+    Run the status daemon on a unix socket until idle for DAEMON_IDLE seconds
+    or asked to quit. Exits quietly when another daemon already owns path.
+
+    Args:
+        path: The unix socket path to listen on
+    """
+    if daemon_running(path):
+        return
+    try:
+        os.unlink(path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
+    old_umask = os.umask(0o077)
+    try:
+        server = StatusServer(path, StatusRequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.last_request = time.time()
+    server.cache = make_status_cache()
+    try:
+        while not server.done and not server.idle():
+            server.handle_request()
+    finally:
+        server.server_close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def print_status(args):
+    """
+    Print the status line as asked for on the command line, see main.
+    """
+    if args.root:
+        try:
+            seed_git_root(os.getcwd(), args.root)
+        except OSError:  # pragma: no cover
+            # cwd was deleted
+            return
+
+    if args.cheap or args.two_tier:
+        try:
+            sys.stdout.write(format_status(traced('cheap', cheap_git_status), args.format) +
+                             ('\n' if args.two_tier else ''))
+            sys.stdout.flush()
+        except (OSError, IOError):  # pragma: no cover
+            return
+        if args.cheap:
+            return
+
+    if args.shared_cache:
+        try:
+            line = directory_status(os.getcwd(), SharedStatusCache(), args.timeout)
+            sys.stdout.write(format_status(line, args.format))
+            sys.stdout.flush()
+        except (OSError, IOError):  # pragma: no cover
+            pass
+        return
+
+    if not sys.stdin.isatty() and not args.spawn and args.timeout is None and not args.two_tier:
+        counter = traced('git_status', read_status, getattr(sys.stdin, 'buffer', sys.stdin))
+        err = u''
+    else:
+        try:
+            counter, err = traced('git_status', run_git_status, None, args.timeout)
+        except StatusTimeout:
+            try:
+                sys.stdout.write(format_status(cheap_git_status(), args.format))
+                sys.stdout.flush()
+            except (OSError, IOError):  # pragma: no cover
+                pass
+            return
+
+    if err.lower().startswith('fatal: not a git repository') or not counter.valid:
+        return
+
+    try:
+        sys.stdout.write(format_status(current_git_status(counter), args.format))
+        sys.stdout.flush()
+    except OSError:  # pragma: no cover
+        # this can happen if cwd is deleted
+        pass
+    except IOError:  # pragma: no cover
+        pass
+
+
+def non_negative_int(text):
+    """
+    argparse type for counts where 0 picks the default.
+    """
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError('must be 0 or more: {0}'.format(value))
+    return value
+
+
+def main():
+    """
+    This program can be run three ways:
+        1) `./git-super-status-parser.py`
+            Will wait on subprocess to execute below git status command.
+
+        2) `git status --porcelain=v2 --branch -z | ./git-super-status-parser.py`
+            Will read stdin and parse it, the older `--branch --porcelain`
+            output is understood too.
+
+        3) `./git-super-status-parser.py --daemon [--socket PATH]`
+            Will serve status lines to the shell over a unix socket.
+
+    With --timeout git status is given up on after that many seconds and the
+    numbers it would have provided are printed as SYM_UNKNOWN.
+
+    With --cheap only the cheap_git_status line is printed, --two-tier prints
+    that line first and then the full line once git status finishes.
+
+    --format picks how the status is printed, see format_status.
+
+    With --shared-cache the status of the repository is taken from, or
+    published to, the SharedStatusCache all of the user's shells share.
+
+    With `--scan DIR` the repositories below DIR are reported as NDJSON, see
+    scan, --timeout then applies to each repository and defaults to 10.
+
+    With ZSH_GIT_PROMPT_TRACE=1 the phase timings are appended to the trace
+    log, `--timings N` summarizes the last N prompts in it.
+    """
+    parser = argparse.ArgumentParser(description='print the git status line for the prompt')
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help='serve status requests on a unix socket')
+    parser.add_argument('--socket', metavar='PATH', default=None,
+                        help='socket path for --daemon, see ZSH_GIT_PROMPT_SOCKET')
+    parser.add_argument('--spawn', action='store_true', default=False,
+                        help='run git status even when stdin is not a terminal')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=None,
+                        help='give up on git status after SECONDS, implies --spawn')
+    parser.add_argument('--cheap', action='store_true', default=False,
+                        help='only print what the files under .git tell, no git status')
+    parser.add_argument('--two-tier', action='store_true', default=False,
+                        help='print the --cheap line then the full line, implies --spawn')
+    parser.add_argument('--root', metavar='DIR', default=None,
+                        help='the worktree the CWD is in when already known, skips the search')
+    parser.add_argument('--timings', metavar='N', type=int, default=None,
+                        help='print p50/p95/p99 per phase over the last N traced prompts')
+    parser.add_argument('--shared-cache', action='store_true', default=False,
+                        help='reuse the status another shell just computed, implies --spawn')
+    parser.add_argument('--format', choices=('line', 'zsh-assoc', 'json'), default='line',
+                        help='how the status is printed, zsh-assoc is for eval by the shell glue')
+    parser.add_argument('--scan', metavar='DIR', default=None,
+                        help='print a json line for each repository below DIR, submodules included')
+    parser.add_argument('--jobs', metavar='N', type=non_negative_int, default=None,
+                        help='repositories --scan works on at once, defaults to the CPU count, also when 0')
+    args = parser.parse_args()
+
+    if args.scan:
+        scan(args.scan, args.jobs, 10 if args.timeout is None else args.timeout)
+        return
+
+    if args.timings is not None:
+        print_timings(args.timings)
+        return
+
+    if args.daemon:
+        serve(args.socket or socket_path())
+        return
+
+    trace_start(TRACE_ID)
+    started = os.environ.get('__GSS_TRACE_START')
+    if TRACE_ID and started:
+        try:
+            # from the shell forking us to here, interpreter start and imports
+            trace_record('startup', time.time() - float(started))
+        except ValueError:
+            pass
+    start = clock()
+    try:
+        print_status(args)
+    finally:
+        trace_record('parser', clock() - start)
+        trace_flush()
 
 
 if __name__ == "__main__":
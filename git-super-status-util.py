@@ -1,35 +1,144 @@
 #!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
 import sys, re, json
+try:
+  from functools import lru_cache
+except ImportError:
+  # python 2, unbounded but the templates are few
+  def lru_cache(maxsize=None):
+    def decorate(func):
+      memo = {}
+      def cached(text):
+        if text not in memo:
+          memo[text] = func(text)
+        return memo[text]
+      return cached
+    return decorate
 
-if len(sys.argv) > 2 and sys.argv[1] == 'strip':
-  print(re.sub(r"%\{|%\}|%[1-9]?G","",sys.argv[2]))
+STRIP_PATTERN = re.compile(r"%\{|%\}|%[1-9]?G")
+# escape sequences and %{...%} segments are compared but never marked, numbers are marked on their own
+SEGMENT_PATTERN = re.compile(r"(\x1b\[[0-9;]*[A-Za-z]|%\{.*?%\}|[0-9]+)")
+# ends the stripped block in `batch ... diff` output, the diff follows it
+BLOCK_END = '\x1e'
 
-elif len(sys.argv) > 5 and sys.argv[1] == 'diff':
-  before = sys.argv[2].split('\n')
-  after = sys.argv[3].split('\n')
-  begin_mark = sys.argv[4]
-  end_mark = sys.argv[5]
 
-  # [won't work in 2.6] before_lines = {line.split(':',1)[0]:line for line in before}
-  before_lines = {}
-  for line in before:
-    before_lines[line.split(':',1)[0]] = line
+@lru_cache(maxsize=1024)
+def strip_prompt(template):
+  # the prompt escapes removed, memoized since the same theme strings come by on every prompt
+  return STRIP_PATTERN.sub('', template)
 
+
+def strip_records(records, skip_zeros=False):
+  # records are <value><TAB><string-to-strip> or <value><TAB><head><TAB><tail>
+  # lines, the latter make <head><value><tail> with only the theme parts head and
+  # tail stripped, so they are the same strings every prompt and come from the
+  # memo, skip-zeros drops the records whose value is 0
+  stripped = []
+  for record in records:
+    fields = record.split('\t')
+    if len(fields) < 2 or skip_zeros and fields[0] == '0':
+      continue
+    if len(fields) == 3:
+      stripped.append(strip_prompt(fields[1]) + fields[0] + strip_prompt(fields[2]))
+    else:
+      stripped.append(strip_prompt('\t'.join(fields[1:])))
+  return stripped
+
+
+def parse_records(lines):
+  # [(key, value)] for the lines of a status block, value is what follows
+  # the first `:` or None for lines without one
+  records = []
+  for line in lines:
+    key, sep, value = line.partition(':')
+    records.append((key, value if sep else None))
+  return records
+
+
+def mark_value(before, after, begin_mark, end_mark):
+  # mark the parts of after that differ from before, e.g. only the number in
+  # `<color>●12<reset>`, the color active before a mark is restored after it
+  old_parts = SEGMENT_PATTERN.split(before)
+  new_parts = SEGMENT_PATTERN.split(after)
+  if len(old_parts) != len(new_parts):
+    return begin_mark + after + end_mark
+
+  marked = []
+  active = ''
+  for i, (old, new) in enumerate(zip(old_parts, new_parts)):
+    if i % 2 and not new.isdigit():
+      active = new
+      marked.append(new)
+    elif old != new and new:
+      marked.append(begin_mark + new + end_mark + active)
+    else:
+      marked.append(new)
+  return ''.join(marked)
+
+
+def diff_records(before, after, begin_mark, end_mark):
+  # the lines of the after records with what changed since the before
+  # records marked, a changed Root means another repository so the lines
+  # after it are left alone
+  before_values = dict(before)
+  lines = []
   keep_diffing = True
-  for i, line in enumerate(after):
-    key, value = line.split(':', 1) if ':' in line else (line, ' ')
-    if key in before_lines.keys() and before_lines[key] != line and keep_diffing:
+  for key, value in after:
+    line = key if value is None else key + ':' + value
+    if keep_diffing and key in before_values and before_values[key] != value:
       if 'Root' in key:
         keep_diffing = False
-      else: 
-        pass
-      if '%{' in line:
-        after[i] = begin_mark + key + ':' + end_mark + value
+      if value is None or before_values[key] is None:
+        line = begin_mark + line + end_mark
       else:
-        after[i] = begin_mark + line + end_mark
+        line = key + ':' + mark_value(before_values[key], value, begin_mark, end_mark)
+    lines.append(line)
+  return lines
+
+
+def status_diff(before, after, begin_mark, end_mark):
+  return '\n'.join(diff_records(parse_records(before.split('\n')), parse_records(after.split('\n')),
+                                begin_mark, end_mark))
+
+
+def batch(records, skip_zeros=False, previous=None, begin_mark='', end_mark=''):
+  # the stripped block of records, with previous not None followed by
+  # BLOCK_END and the block marked against previous, empty previous
+  # means there's nothing to diff against
+  lines = strip_records(records, skip_zeros)
+  block = '\n'.join(lines)
+  if previous is None:
+    return block
+  if previous and lines:
+    marked = '\n'.join(diff_records(parse_records(previous.split('\n')), parse_records(lines),
+                                    begin_mark, end_mark))
+  else:
+    marked = block
+  return block + BLOCK_END + marked
+
+
+def main(argv):
+  if len(argv) > 2 and argv[1] == 'strip':
+    print(strip_prompt(argv[2]))
+
+  elif len(argv) > 5 and argv[1] == 'diff':
+    print(status_diff(argv[2], argv[3], argv[4], argv[5]))
+
+  elif len(argv) > 1 and argv[1] == 'batch':
+    # batch [skip-zeros] [diff <previous-block> <begin-mark> <end-mark>], with diff the
+    # stripped block is followed by BLOCK_END and the block marked against the previous one
+    skip_zeros = len(argv) > 2 and argv[2] == 'skip-zeros'
+    records = sys.stdin.read().split('\n')
+    if 'diff' in argv[2:4] and len(argv) > argv.index('diff') + 3:
+      previous, begin_mark, end_mark = argv[argv.index('diff') + 1:argv.index('diff') + 4]
+      print(batch(records, skip_zeros, previous, begin_mark, end_mark))
+    else:
+      print(batch(records, skip_zeros))
+
+  else:
+    raise ValueError('First parameter should be one of: strip, diff, batch')
 
-  print('\n'.join(after))
 
-else:
-  raise ValueError('First parameter should be one of: strip, diff')
\ No newline at end of file
+if __name__ == '__main__':
+  main(sys.argv)
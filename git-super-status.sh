@@ -6,17 +6,121 @@
 # 
 
 chpwd-git-super-status() {
+  gss-find-root
+}
+
+gss-find-root() {
+  # args: none, sets __GSS_GIT_ROOT to the worktree enclosing $PWD, empty outside a repository
+  # the __GSS_ROOTS directory to worktree cache is only trusted while the .git it found still
+  # exists and $PWD hasn't grown a .git of its own, preexec empties it after git init/clone
+  declare -gA __GSS_ROOTS
+  declare -g __GSS_GIT_ROOT
+  local dir="$PWD"
+  if (( ${+__GSS_ROOTS[$dir]} )) ; then
+    __GSS_GIT_ROOT="${__GSS_ROOTS[$dir]}"
+    if [[ ( -z "$__GSS_GIT_ROOT" || -e "$__GSS_GIT_ROOT/.git" ) &&
+          ( "$__GSS_GIT_ROOT" == "$dir" || ! -e "$dir/.git" ) ]] ; then
+      return
+    fi
+  fi
+  __GSS_GIT_ROOT=""
+  while [[ "$dir" != "/" ]] ; do
+    if [[ -e "$dir/.git" ]] ; then
+      __GSS_GIT_ROOT="$dir"
+      break
+    fi
+    dir="${dir:h}"
+  done
+  __GSS_ROOTS[$PWD]="$__GSS_GIT_ROOT"
 }
 
 precmd-git-super-status() {
-  git-super-status-update-vars
+  if [[ "$ZSH_GIT_PROMPT_TRACE" == "1" ]] ; then
+    zmodload zsh/datetime
+    declare -gi __GSS_TRACE_SEQ
+    export __GSS_TRACE_ID="$$.$(( ++__GSS_TRACE_SEQ ))"
+  elif [[ -n "$__GSS_TRACE_ID" ]] ; then
+    unset __GSS_TRACE_ID
+  fi
+  local t0=$EPOCHREALTIME t1
+  gss-find-root
+  gss-trace find_root $t0
+  if gss-backoff-skip ; then
+    # a slow repository, keep showing the status from the last refresh
+    __GIT_FULL_STATUS_DIFF=""
+  elif [[ -n "$ZSH_GIT_PROMPT_ASYNC" && -o zle ]] ; then
+    gss-async-refresh
+  else
+    t1=$EPOCHREALTIME
+    git-super-status-update-vars
+    gss-trace update_vars $t1
+    gss-backoff-record $t1
+    t1=$EPOCHREALTIME
+    gss-update-full-status
+    gss-trace full_status $t1
+  fi
+  __GSS_STATE_COMMAND=""
+  gss-trace precmd $t0
+}
+
+gss-backoff-skip() {
+  # args: none, true when this prompt should keep the last status because the repository took over
+  # ZSH_GIT_PROMPT_SLOW_MS to refresh ZSH_GIT_PROMPT_SLOW_RUNS times in a row, it is refreshed again
+  # after ZSH_GIT_PROMPT_BACKOFF seconds or a command preexec expects to change it, sets GIT_CACHED_AGE
+  declare -gA __GSS_SLOW_RUNS __GSS_REFRESHED
+  declare -g GIT_CACHED_AGE=""
+  local backoff="${ZSH_GIT_PROMPT_BACKOFF:-30}" age
+  [[ "$backoff" != "0" && -n "$__GSS_GIT_ROOT" && -z "$__GSS_STATE_COMMAND" ]] || return 1
+  [[ -n "$__CURRENT_GIT_STATUS" && "$GIT_REPO_ROOT" == "$__GSS_GIT_ROOT" ]] || return 1
+  (( ${__GSS_SLOW_RUNS[$__GSS_GIT_ROOT]:-0} >= ${ZSH_GIT_PROMPT_SLOW_RUNS:-3} )) || return 1
+  age=$(( EPOCHREALTIME - ${__GSS_REFRESHED[$__GSS_GIT_ROOT]:-0} ))
+  (( age < backoff )) || return 1
+  GIT_CACHED_AGE="${age%.*}"
+}
+
+gss-backoff-record() {
+  # args: <start>, counts the refresh of this repository started at <start> (an EPOCHREALTIME) as slow
+  # when it took ZSH_GIT_PROMPT_SLOW_MS or longer, a faster one ends the backoff
+  declare -gA __GSS_SLOW_RUNS __GSS_REFRESHED
+  [[ -n "$__GSS_GIT_ROOT" && -n "$1" ]] || return 0
+  if (( (EPOCHREALTIME - $1) * 1000 >= ${ZSH_GIT_PROMPT_SLOW_MS:-1000} )) ; then
+    __GSS_SLOW_RUNS[$__GSS_GIT_ROOT]=$(( ${__GSS_SLOW_RUNS[$__GSS_GIT_ROOT]:-0} + 1 ))
+    __GSS_REFRESHED[$__GSS_GIT_ROOT]=$EPOCHREALTIME
+  else
+    unset "__GSS_SLOW_RUNS[$__GSS_GIT_ROOT]" "__GSS_REFRESHED[$__GSS_GIT_ROOT]"
+  fi
+}
+
+gss-trace() {
+  # args: <phase> <start>, logs the time since <start> (an EPOCHREALTIME) as <phase> of this prompt
+  # when ZSH_GIT_PROMPT_TRACE=1, see git-super-status --timings
+  [[ -n "$__GSS_TRACE_ID" && -n "$2" ]] || return 0
+  printf '%s\t%s\t%.3f\n' "$__GSS_TRACE_ID" "$1" $(( (EPOCHREALTIME - $2) * 1000 )) >> "$__GIT_STATUS_TRACE_FILE"
+}
 
-  declare -g __GIT_FULL_STATUS="$(git-super-status skip-zeros)"
+gss-update-full-status() {
+  # args: none, sets __GIT_FULL_STATUS_DIFF to the status block when it changed since the last prompt
+  declare -g __GIT_FULL_STATUS
   declare -g __GIT_PREV_FULL_STATUS
   declare -g __GIT_PREV_ROOT
   declare -g __GIT_FULL_STATUS_DIFF
+  local previous="" block="" marked=""
+
+  if [[ -n "$__CURRENT_GIT_STATUS" ]] ; then
+    # the block and the block marked against the previous one in one daemon request or util call
+    [[ "$__GIT_PREV_ROOT" == "$GIT_REPO_ROOT" ]] && previous="$__GIT_PREV_FULL_STATUS"
+    gss-full-status-records
+    if gss-daemon-batch 1 "$previous" "$FG[196]" "%{${reset_color}%}" "${reply[@]}" ; then
+      block="$REPLY"
+    else
+      block="$(print -r -l -- "${reply[@]}" | "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_UTIL" batch skip-zeros diff "$previous" "$FG[196]" "%{${reset_color}%}")"
+    fi
+    marked="${block#*$'\x1e'}"
+    block="${block%%$'\x1e'*}"
+  fi
+  __GIT_FULL_STATUS="$block"
 
-  # echo "Function precmd-git-super-status()" >>/tmp/gss.log
+  # echo "Function gss-update-full-status()" >>/tmp/gss.log
   # echo "  pc \$__GIT_FULL_STATUS='$__GIT_FULL_STATUS'" >>/tmp/gss.log
   # echo "  pc \$__GIT_PREV_FULL_STATUS='$__GIT_PREV_FULL_STATUS'" >>/tmp/gss.log
 
@@ -25,7 +129,7 @@ precmd-git-super-status() {
     __GIT_FULL_STATUS=""
   else
     if [[ -n "$__GIT_FULL_STATUS" && -n "$__GIT_PREV_FULL_STATUS" && "$__GIT_PREV_ROOT" == "$GIT_REPO_ROOT" ]] ; then
-      __GIT_FULL_STATUS_DIFF="$(gss-status-diff "$__GIT_PREV_FULL_STATUS" "$__GIT_FULL_STATUS" "$FG[196]" "%{${reset_color}%}")"
+      __GIT_FULL_STATUS_DIFF="$marked"
     else
       __GIT_FULL_STATUS_DIFF="$__GIT_FULL_STATUS"
     fi
@@ -37,37 +141,129 @@ precmd-git-super-status() {
 }
 
 preexec-git-super-status() {
+  declare -g __GSS_STATE_COMMAND
+  local word
   __GIT_FULL_STATUS=""
+  if [[ "$1" == *(git init|git clone|git worktree|git submodule)* ]] ; then
+    __GSS_ROOTS=()
+  fi
+  # commands that likely change the repository end a slow repository's backoff for the next prompt
+  for word in ${(z)1} ; do
+    if [[ "${word:t}" == ${~ZSH_GIT_PROMPT_BACKOFF_COMMANDS:-(git|tig|make|ninja|vi|vim|nvim|emacs|emacsclient|nano|code|subl)} ]] ; then
+      __GSS_STATE_COMMAND=1
+      break
+    fi
+  done
 }
 
 git-super-status-update-vars() {
-  unset __CURRENT_GIT_STATUS
-  __GIT_CMD=$(git status --porcelain --branch &> /dev/null 2>&1 | ZSH_THEME_GIT_PROMPT_HASH_PREFIX=$ZSH_THEME_GIT_PROMPT_HASH_PREFIX "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_PARSER")
-  __CURRENT_GIT_STATUS=("${(@s: :)__GIT_CMD}")
+  (( ${+__GSS_GIT_ROOT} )) || gss-find-root
+  if [[ -z "$__GSS_GIT_ROOT" ]] ; then
+    __GIT_CMD=""
+  elif [[ -n "$ZSH_GIT_PROMPT_BRANCH_ONLY" ]] ; then
+    if ! gss-daemon-query "$PWD"$'\t'"cheap=1" ; then
+      __GIT_CMD=$(__GSS_TRACE_START=$EPOCHREALTIME ZSH_THEME_GIT_PROMPT_HASH_PREFIX=$ZSH_THEME_GIT_PROMPT_HASH_PREFIX "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_PARSER" --cheap --format=zsh-assoc --root "$__GSS_GIT_ROOT")
+    fi
+  elif ! gss-daemon-query ; then
+    [[ -n "$ZSH_GIT_PROMPT_DAEMON" ]] && git-super-status-daemon start
+    __GIT_CMD=$(__GSS_TRACE_START=$EPOCHREALTIME ZSH_THEME_GIT_PROMPT_HASH_PREFIX=$ZSH_THEME_GIT_PROMPT_HASH_PREFIX "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_PARSER" --spawn ${ZSH_GIT_PROMPT_SHARED_CACHE:+--shared-cache} --format=zsh-assoc --root "$__GSS_GIT_ROOT")
+  fi
+  gss-parse-status-line
+}
+
+gss-parse-status-line() {
+  # args: none, sets the GIT_* variables from the `--format=zsh-assoc` parser output in __GIT_CMD
+  unset __CURRENT_GIT_STATUS GIT_STATUS
+  eval "$__GIT_CMD"
+  __CURRENT_GIT_STATUS="$__GIT_CMD"
   unset __GIT_CMD
 
-  GIT_BRANCH=$__CURRENT_GIT_STATUS[1]
-  GIT_AHEAD=$__CURRENT_GIT_STATUS[2]
-  GIT_BEHIND=$__CURRENT_GIT_STATUS[3]
-  GIT_STAGED=$__CURRENT_GIT_STATUS[4]
-  GIT_CONFLICTS=$__CURRENT_GIT_STATUS[5]
-  GIT_CHANGED=$__CURRENT_GIT_STATUS[6]
-  GIT_UNTRACKED=$__CURRENT_GIT_STATUS[7]
-  GIT_STASHED=$__CURRENT_GIT_STATUS[8]
-  GIT_LOCAL_ONLY=$__CURRENT_GIT_STATUS[9]
-  GIT_UPSTREAM=$__CURRENT_GIT_STATUS[10]
-  GIT_MERGING=$__CURRENT_GIT_STATUS[11]
-  GIT_REBASE=$__CURRENT_GIT_STATUS[12]
-  GIT_REPO_SLUG=$__CURRENT_GIT_STATUS[13]
-
-  if [[ -n "$GIT_REPO_SLUG" ]] ; then
-    GIT_REPO_ROOT="$(dirname "$(url-decode "$GIT_REPO_SLUG")")"
+  GIT_BRANCH=$GIT_STATUS[branch]
+  GIT_AHEAD=$GIT_STATUS[ahead]
+  GIT_BEHIND=$GIT_STATUS[behind]
+  GIT_STAGED=$GIT_STATUS[staged]
+  GIT_CONFLICTS=$GIT_STATUS[conflicts]
+  GIT_CHANGED=$GIT_STATUS[changed]
+  GIT_UNTRACKED=$GIT_STATUS[untracked]
+  GIT_STASHED=$GIT_STATUS[stashes]
+  GIT_LOCAL_ONLY=$GIT_STATUS[local]
+  GIT_UPSTREAM=$GIT_STATUS[upstream]
+  GIT_MERGING=$GIT_STATUS[merge]
+  GIT_REBASE=$GIT_STATUS[rebase]
+  GIT_REPO_ROOT=$GIT_STATUS[root]
+  GIT_SUBMODULES_DIRTY=$GIT_STATUS[sub_dirty]
+  GIT_SUBMODULES_COMMIT=$GIT_STATUS[sub_commit]
+}
+
+gss-async-refresh() {
+  # args: none, keeps showing the last status marked stale while a background job recomputes it
+  declare -g __GSS_ASYNC_FD __GSS_ASYNC_CHEAP __GSS_ASYNC_T0 GIT_STALE
+  __GIT_FULL_STATUS_DIFF=""
+  if [[ -n "$__GSS_ASYNC_FD" ]] ; then
+    zle -F $__GSS_ASYNC_FD
+    exec {__GSS_ASYNC_FD}<&-
+  fi
+  if [[ -n "$GIT_REPO_ROOT" && "$GIT_REPO_ROOT" == "$__GSS_GIT_ROOT" ]] ; then
+    GIT_STALE=1
+  else
+    # the last status is for another repository, nothing worth showing
+    unset __CURRENT_GIT_STATUS
+    GIT_STALE=0
+  fi
+  __GSS_ASYNC_CHEAP=""
+  if [[ -z "$__GSS_GIT_ROOT" ]] ; then
+    __GIT_CMD=""
+    gss-parse-status-line
+    gss-update-full-status
+    return
+  fi
+  __GSS_ASYNC_T0=$EPOCHREALTIME
+  exec {__GSS_ASYNC_FD}< <(gss-async-worker)
+  zle -F $__GSS_ASYNC_FD gss-async-callback
+}
+
+gss-async-worker() {
+  # args: none, prints the cheap status line for $PWD then the full one, giving up on
+  # git status after ZSH_GIT_PROMPT_TIMEOUT seconds, prints an empty line outside a repository
+  local __GIT_CMD timeout="${ZSH_GIT_PROMPT_TIMEOUT:-10}"
+  if gss-daemon-query "$PWD"$'\t'"cheap=1" ; then
+    print -r -- "$__GIT_CMD"
+    [[ -n "$__GIT_CMD" ]] && gss-daemon-query "$PWD"$'\t'"timeout=$timeout" && print -r -- "$__GIT_CMD"
   else
-    GIT_REPO_ROOT=""
+    __GSS_TRACE_START=$EPOCHREALTIME ZSH_THEME_GIT_PROMPT_HASH_PREFIX=$ZSH_THEME_GIT_PROMPT_HASH_PREFIX "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_PARSER" --two-tier --timeout "$timeout" ${ZSH_GIT_PROMPT_SHARED_CACHE:+--shared-cache} --format=zsh-assoc --root "$__GSS_GIT_ROOT"
+    print
+  fi
+}
+
+gss-async-callback() {
+  # args: <fd> [ <error> ], zle -F handler that shows the lines printed by gss-async-worker
+  local fd=$1 __GIT_CMD got=""
+  read -r -u $fd __GIT_CMD && got=1
+  if [[ -n "$got" && -n "$__GIT_CMD" && -z "$__GSS_ASYNC_CHEAP" ]] ; then
+    # the cheap line, keep listening for the full one
+    __GSS_ASYNC_CHEAP=1
+    gss-parse-status-line
+    GIT_STALE=1
+    gss-trace async_cheap $__GSS_ASYNC_T0
+    zle reset-prompt
+    return
+  fi
+  zle -F $fd
+  exec {fd}<&-
+  unset __GSS_ASYNC_FD __GSS_ASYNC_CHEAP
+  # nothing to read means the worker died, keep showing what we have
+  if [[ -n "$got" ]] ; then
+    gss-parse-status-line
   fi
+  GIT_STALE=0
+  gss-backoff-record $__GSS_ASYNC_T0
+  gss-update-full-status
+  gss-trace async_full $__GSS_ASYNC_T0
+  zle reset-prompt
 }
 
 git-super-status-prompt() {
+    local t0=$EPOCHREALTIME
 
     if [ -n "$__CURRENT_GIT_STATUS" ]; then
         local STATUS="$ZSH_THEME_GIT_PROMPT_PREFIX$ZSH_THEME_GIT_PROMPT_BRANCH$GIT_BRANCH%{${reset_color}%}"
@@ -89,31 +285,40 @@ git-super-status-prompt() {
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_UPSTREAM_FRONT$GIT_UPSTREAM$ZSH_THEME_GIT_PROMPT_UPSTREAM_END%{${reset_color}%}"
         fi
 
-        if [ "$GIT_BEHIND" -ne "0" ] || [ "$GIT_AHEAD" -ne "0" ]; then
+        # numbers are `?` when they could not be computed in time, counts are
+        # e.g. `999+` when they reached ZSH_GIT_PROMPT_MAX_COUNT
+        if [[ "$GIT_BEHIND" == <1-> || "$GIT_AHEAD" == <1-> ]]; then
             STATUS="$STATUS "
         fi
-        if [ "$GIT_BEHIND" -ne "0" ]; then
+        if [[ "$GIT_BEHIND" == <1-> ]]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_BEHIND$GIT_BEHIND%{${reset_color}%}"
         fi
-        if [ "$GIT_AHEAD" -ne "0" ]; then
+        if [[ "$GIT_AHEAD" == <1-> ]]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_AHEAD$GIT_AHEAD%{${reset_color}%}"
         fi
 
         STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_SEPARATOR"
 
-        if [ "$GIT_STAGED" -ne "0" ]; then
+        if [ "$GIT_STAGED" = "?" ]; then
+            # not counted yet, or git status was too slow to wait for
+            if [ "$GIT_STALE" != "1" ] && [ -z "$ZSH_GIT_PROMPT_BRANCH_ONLY" ]; then
+                STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_SLOW%{${reset_color}%}"
+            fi
+            clean=0
+        fi
+        if [[ "$GIT_STAGED" == <1->(|+) ]]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_STAGED$GIT_STAGED%{${reset_color}%}"
             clean=0
         fi
-        if [ "$GIT_CONFLICTS" -ne "0" ]; then
+        if [[ "$GIT_CONFLICTS" == <1->(|+) ]]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_CONFLICTS$GIT_CONFLICTS%{${reset_color}%}"
             clean=0
         fi
-        if [ "$GIT_CHANGED" -ne "0" ]; then
+        if [[ "$GIT_CHANGED" == <1->(|+) ]]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_CHANGED$GIT_CHANGED%{${reset_color}%}"
             clean=0
         fi
-        if [ "$GIT_UNTRACKED" -ne "0" ]; then
+        if [[ "$GIT_UNTRACKED" == <1->(|+) ]]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_UNTRACKED$GIT_UNTRACKED%{${reset_color}%}"
             clean=0
         fi
@@ -121,12 +326,27 @@ git-super-status-prompt() {
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_STASHED$GIT_STASHED%{${reset_color}%}"
             clean=0
         fi
+        if [[ "$GIT_SUBMODULES_DIRTY" == <1-> ]]; then
+            STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_SUBMODULES_DIRTY$GIT_SUBMODULES_DIRTY%{${reset_color}%}"
+            clean=0
+        fi
+        if [[ "$GIT_SUBMODULES_COMMIT" == <1-> ]]; then
+            STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_SUBMODULES_COMMIT$GIT_SUBMODULES_COMMIT%{${reset_color}%}"
+            clean=0
+        fi
         if [ "$clean" -eq "1" ]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_CLEAN%{${reset_color}%}"
         fi
+        if [ "$GIT_STALE" = "1" ]; then
+            STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_STALE%{${reset_color}%}"
+        fi
+        if [ -n "$GIT_CACHED_AGE" ]; then
+            STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_CACHED_FRONT$GIT_CACHED_AGE$ZSH_THEME_GIT_PROMPT_CACHED_END%{${reset_color}%}"
+        fi
         echo "%{${reset_color}%}$STATUS$ZSH_THEME_GIT_PROMPT_SUFFIX%{${reset_color}%}"
 
     fi
+    gss-trace prompt $t0
 }
 
 gss-strip-prompt() {
@@ -141,6 +361,75 @@ gss-strip-prompt-if() {
   fi
 }
 
+gss-strip-prompt-batch() {
+  # args: [ 'skip-zeros' ], stdin: one <value><TAB><string-to-strip> or <value><TAB><head><TAB><tail> record per line
+  "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_UTIL" batch "$1"
+}
+
+gss-daemon-query() {
+  # args: [ <request> ], sets __GIT_CMD to the daemon reply, fails when the daemon isn't running
+  [[ -S "$__GIT_STATUS_SOCKET" ]] || return 1
+  zmodload zsh/net/socket 2>/dev/null || return 1
+  zsocket "$__GIT_STATUS_SOCKET" 2>/dev/null || return 1
+  local fd=$REPLY request="${1:-$PWD}"
+  if [[ "$request" == /* ]] ; then
+    request="$request"$'\t'"format=zsh-assoc"
+    [[ -n "$__GSS_GIT_ROOT" ]] && request="$request"$'\t'"root=$__GSS_GIT_ROOT"
+    [[ -n "$__GSS_TRACE_ID" ]] && request="$request"$'\t'"trace=$__GSS_TRACE_ID"
+  fi
+  print -r -u $fd -- "$request"
+  read -r -u $fd __GIT_CMD
+  local rc=$?
+  exec {fd}>&-
+  return $rc
+}
+
+gss-daemon-batch() {
+  # args: <skip-zeros 0|1> <previous-block> <begin-marker> <end-marker> <record>..., sets REPLY to what
+  # `git-super-status-util.py batch ... diff` prints, from the daemon whose memo already has the theme
+  # strings stripped, fails when the daemon isn't running
+  [[ -S "$__GIT_STATUS_SOCKET" ]] || return 1
+  zmodload zsh/net/socket 2>/dev/null || return 1
+  zsocket "$__GIT_STATUS_SOCKET" 2>/dev/null || return 1
+  local fd=$REPLY line
+  print -r -u $fd -- "!batch"$'\t'"skip-zeros=$1"$'\t'"diff=1"$'\t'"begin=$3"$'\t'"end=$4"
+  [[ -n "$2" ]] && for line in "${(@f)2}" ; do print -r -u $fd -- "p"$'\t'"$line" ; done
+  for line in "${@[5,-1]}" ; do print -r -u $fd -- "r"$'\t'"$line" ; done
+  print -u $fd
+  REPLY=""
+  IFS= read -r -d '' -u $fd REPLY
+  exec {fd}>&-
+  REPLY="${REPLY%$'\n'}"
+  [[ -n "$REPLY" ]]
+}
+
+git-super-status-daemon() {
+  # args: start | stop | status
+  local __GIT_CMD
+  case "$1" in
+    start)
+      if ! gss-daemon-query '!ping' ; then
+        ( ZSH_THEME_GIT_PROMPT_HASH_PREFIX=$ZSH_THEME_GIT_PROMPT_HASH_PREFIX "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_PARSER" --daemon --socket "$__GIT_STATUS_SOCKET" &> /dev/null & )
+      fi
+      ;;
+    stop)
+      gss-daemon-query '!quit'
+      ;;
+    status)
+      if gss-daemon-query '!ping' ; then
+        echo "git-super-status daemon running on $__GIT_STATUS_SOCKET ($__GIT_CMD)"
+      else
+        echo "git-super-status daemon not running"
+        return 1
+      fi
+      ;;
+    *)
+      echo "Usage: git-super-status-daemon start | stop | status"
+      return 1
+      ;;
+  esac
+}
+
 gss-status-diff() {
   # args: <before-status> <after-status> <begin-marker> <end-marker>
   "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_UTIL" diff "$1" "$2" "$3" "$4"
@@ -150,33 +439,13 @@ git-super-status() {
   # echo "Function git-super-status()" >>/tmp/gss.log
   # echo "  \$__GIT_FULL_STATUS_DIFF='$__GIT_FULL_STATUS_DIFF'" >>/tmp/gss.log
   # echo "  \$__CURRENT_GIT_STATUS='$__CURRENT_GIT_STATUS'" >>/tmp/gss.log
-  if [[ -z "$1" || "$1" == "skip-zeros" ]] ; then
+  if [[ "$1" == "--timings" ]] ; then
+    # per phase percentiles of the prompts traced with ZSH_GIT_PROMPT_TRACE=1
+    "$__GIT_STATUS_PY_BIN" "$__GIT_STATUS_PARSER" --timings "${2:-100}"
+  elif [[ -z "$1" || "$1" == "skip-zeros" ]] ; then
     if [ -n "$__CURRENT_GIT_STATUS" ] ; then
-      gss-strip-prompt $' \nSuper Git Status: [git-super-status output]' 
-      gss-strip-prompt  "  Root: $GIT_REPO_ROOT"
-      if [ "$GIT_LOCAL_ONLY" -ne "0" ]; then
-          gss-strip-prompt  "  Branch: $ZSH_THEME_GIT_PROMPT_LOCAL%{${reset_color}%}"
-      elif [ "$ZSH_GIT_PROMPT_SHOW_UPSTREAM" -gt "0" ] && [ -n "$GIT_UPSTREAM" ] && [ "$GIT_UPSTREAM" != ".." ]; then
-          local parts=( "${(s:/:)GIT_UPSTREAM}" )
-          if [ "$ZSH_GIT_PROMPT_SHOW_UPSTREAM" -eq "2" ] && [ "$parts[2]" = "$GIT_BRANCH" ]; then
-              GIT_UPSTREAM="$parts[1]"
-          fi
-          gss-strip-prompt  "  Branch: $ZSH_THEME_GIT_PROMPT_UPSTREAM_FRONT$GIT_UPSTREAM$ZSH_THEME_GIT_PROMPT_UPSTREAM_END%{${reset_color}%}"
-      fi
-
-      if [ -n "$GIT_REBASE" ] && [ "$GIT_REBASE" != "0" ]; then
-          gss-strip-prompt  "  Status: $ZSH_THEME_GIT_PROMPT_REBASE$GIT_REBASE%{${reset_color}%}"
-      elif [ "$GIT_MERGING" -ne "0" ]; then
-          gss-strip-prompt  "  Status: $STATUS$ZSH_THEME_GIT_PROMPT_MERGING%{${reset_color}%}"
-      fi
-      gss-strip-prompt-if  "  Ahead: $ZSH_THEME_GIT_PROMPT_AHEAD$GIT_AHEAD${reset_color}" "$1" "$GIT_AHEAD"
-      gss-strip-prompt-if  "  Behind: $ZSH_THEME_GIT_PROMPT_BEHIND$GIT_BEHIND${reset_color}" "$1" "$GIT_BEHIND"
-
-      gss-strip-prompt-if  "  Staged: $ZSH_THEME_GIT_PROMPT_STAGED$GIT_STAGED%{${reset_color}%}" "$1" "$GIT_STAGED"
-      gss-strip-prompt-if  "  Conflicts: $ZSH_THEME_GIT_PROMPT_CONFLICTS$GIT_CONFLICTS%{${reset_color}%}" "$1" "$GIT_CONFLICTS"
-      gss-strip-prompt-if  "  Changed: $ZSH_THEME_GIT_PROMPT_CHANGED$GIT_CHANGED%{${reset_color}%}" "$1" "$GIT_CHANGED"
-      gss-strip-prompt-if  "  Untracked: $ZSH_THEME_GIT_PROMPT_UNTRACKED$GIT_UNTRACKED%{${reset_color}%}" "$1" "$GIT_UNTRACKED"
-      gss-strip-prompt-if  "  Stashes: $ZSH_THEME_GIT_PROMPT_STASHED$GIT_STASHED%{${reset_color}%}" "$1" "$GIT_STASHED"
+      gss-full-status-records
+      print -r -l -- "${reply[@]}" | gss-strip-prompt-batch "$1"
     fi
   else
     if [[ -n "$__GIT_FULL_STATUS_DIFF" ]] ; then
@@ -185,6 +454,39 @@ git-super-status() {
   fi
 }
 
+gss-full-status-records() {
+  # args: none, sets reply to the status block as records for gss-strip-prompt-batch, the counts as
+  # <value><TAB><head><TAB><tail> so the theme strings around them are the same every prompt
+  local records=( $'\t ' $'\tSuper Git Status: [git-super-status output]' )
+  records+=( $'\t'"  Root: $GIT_REPO_ROOT" )
+  if [ "$GIT_LOCAL_ONLY" -ne "0" ]; then
+      records+=( $'\t'"  Branch: $ZSH_THEME_GIT_PROMPT_LOCAL%{${reset_color}%}" )
+  elif [ "$ZSH_GIT_PROMPT_SHOW_UPSTREAM" -gt "0" ] && [ -n "$GIT_UPSTREAM" ] && [ "$GIT_UPSTREAM" != ".." ]; then
+      local parts=( "${(s:/:)GIT_UPSTREAM}" )
+      if [ "$ZSH_GIT_PROMPT_SHOW_UPSTREAM" -eq "2" ] && [ "$parts[2]" = "$GIT_BRANCH" ]; then
+          GIT_UPSTREAM="$parts[1]"
+      fi
+      records+=( $'\t'"  Branch: $ZSH_THEME_GIT_PROMPT_UPSTREAM_FRONT$GIT_UPSTREAM$ZSH_THEME_GIT_PROMPT_UPSTREAM_END%{${reset_color}%}" )
+  fi
+
+  if [ -n "$GIT_REBASE" ] && [ "$GIT_REBASE" != "0" ]; then
+      records+=( $'\t'"  Status: $ZSH_THEME_GIT_PROMPT_REBASE$GIT_REBASE%{${reset_color}%}" )
+  elif [ "$GIT_MERGING" -ne "0" ]; then
+      records+=( $'\t'"  Status: $STATUS$ZSH_THEME_GIT_PROMPT_MERGING%{${reset_color}%}" )
+  fi
+  records+=( "$GIT_AHEAD"$'\t'"  Ahead: $ZSH_THEME_GIT_PROMPT_AHEAD"$'\t'"${reset_color}" )
+  records+=( "$GIT_BEHIND"$'\t'"  Behind: $ZSH_THEME_GIT_PROMPT_BEHIND"$'\t'"${reset_color}" )
+
+  records+=( "$GIT_STAGED"$'\t'"  Staged: $ZSH_THEME_GIT_PROMPT_STAGED"$'\t'"%{${reset_color}%}" )
+  records+=( "$GIT_CONFLICTS"$'\t'"  Conflicts: $ZSH_THEME_GIT_PROMPT_CONFLICTS"$'\t'"%{${reset_color}%}" )
+  records+=( "$GIT_CHANGED"$'\t'"  Changed: $ZSH_THEME_GIT_PROMPT_CHANGED"$'\t'"%{${reset_color}%}" )
+  records+=( "$GIT_UNTRACKED"$'\t'"  Untracked: $ZSH_THEME_GIT_PROMPT_UNTRACKED"$'\t'"%{${reset_color}%}" )
+  records+=( "$GIT_STASHED"$'\t'"  Stashes: $ZSH_THEME_GIT_PROMPT_STASHED"$'\t'"%{${reset_color}%}" )
+  records+=( "${GIT_SUBMODULES_DIRTY:-0}"$'\t'"  Submodules changed: $ZSH_THEME_GIT_PROMPT_SUBMODULES_DIRTY"$'\t'"%{${reset_color}%}" )
+  records+=( "${GIT_SUBMODULES_COMMIT:-0}"$'\t'"  Submodules at other commit: $ZSH_THEME_GIT_PROMPT_SUBMODULES_COMMIT"$'\t'"%{${reset_color}%}" )
+  reply=( "${records[@]}" )
+}
+
 alias super-git-status=git-super-status
 
 if which python >/dev/null ; then local py=python ; else local py=python3 ; fi
@@ -197,8 +499,23 @@ export __GIT_PROMPT_DIR="${0:A:h}"
 export __GIT_STATUS_PY_BIN="${ZSH_GIT_PROMPT_PYBIN:-$py}"
 export __GIT_STATUS_UTIL="$__GIT_PROMPT_DIR/git-super-status-util.py"
 export __GIT_STATUS_PARSER="$__GIT_PROMPT_DIR/git-super-status-parser.py"
+if [[ -n "$ZSH_GIT_PROMPT_SOCKET" ]] ; then
+  export __GIT_STATUS_SOCKET="$ZSH_GIT_PROMPT_SOCKET"
+elif [[ -d "$XDG_RUNTIME_DIR" ]] ; then
+  export __GIT_STATUS_SOCKET="$XDG_RUNTIME_DIR/git-super-status.sock"
+else
+  export __GIT_STATUS_SOCKET="/tmp/git-super-status-$UID.sock"
+fi
+if [[ -n "$ZSH_GIT_PROMPT_TRACE_FILE" ]] ; then
+  export __GIT_STATUS_TRACE_FILE="$ZSH_GIT_PROMPT_TRACE_FILE"
+elif [[ -d "$XDG_RUNTIME_DIR" ]] ; then
+  export __GIT_STATUS_TRACE_FILE="$XDG_RUNTIME_DIR/git-super-status-trace.log"
+else
+  export __GIT_STATUS_TRACE_FILE="/tmp/git-super-status-trace-$UID.log"
+fi
 
 # Load required modules
+zmodload zsh/datetime
 autoload -U add-zsh-hook
 autoload -U colors
 colors
@@ -228,10 +545,52 @@ ZSH_THEME_GIT_PROMPT_STASHED="%{$fg[white]%}%{s%G%}"
 ZSH_THEME_GIT_PROMPT_UNTRACKED="%{$fg[cyan]%}%{…%G%}"
 ZSH_THEME_GIT_PROMPT_CLEAN="%{$fg_bold[green]%}%{✔%G%}"
 ZSH_THEME_GIT_PROMPT_LOCAL=" L"
+# Submodules with changes and submodules at another commit than recorded, see ZSH_GIT_PROMPT_SUBMODULES
+ZSH_THEME_GIT_PROMPT_SUBMODULES_DIRTY="%{$fg[yellow]%}%{◆%G%}"
+ZSH_THEME_GIT_PROMPT_SUBMODULES_COMMIT="%{$fg[yellow]%}%{◇%G%}"
 # The remote branch will be shown between these two
 ZSH_THEME_GIT_PROMPT_UPSTREAM_FRONT=" {%{$fg[blue]%}"
 ZSH_THEME_GIT_PROMPT_UPSTREAM_END="%{${reset_color}%}}"
 ZSH_THEME_GIT_PROMPT_MERGING="%{$fg_bold[magenta]%}|MERGING%{${reset_color}%}"
 ZSH_THEME_GIT_PROMPT_REBASE="%{$fg_bold[magenta]%}|REBASE%{${reset_color}%} "
+# Shown while ZSH_GIT_PROMPT_ASYNC is recomputing the status and when git status timed out
+ZSH_THEME_GIT_PROMPT_STALE="%{$fg[yellow]%}%{~%G%}"
+ZSH_THEME_GIT_PROMPT_SLOW="%{$fg[yellow]%}slow repo"
+# The age in seconds of the status kept for a slow repository will be shown between these two
+ZSH_THEME_GIT_PROMPT_CACHED_FRONT=" %{$fg[yellow]%}cached "
+ZSH_THEME_GIT_PROMPT_CACHED_END="s ago"
+
+# Set ZSH_GIT_PROMPT_BRANCH_ONLY to any non-null value to only show the branch, upstream, ahead/behind,
+# stashes and merge/rebase state, read from the files under .git without running git
+
+# Export ZSH_GIT_PROMPT_SUBMODULES=1 to count the submodules with changes and the submodules whose
+# HEAD isn't the commit the superproject records, the latter is read from the files under .git
+
+# Set ZSH_GIT_PROMPT_MAX_COUNT to a number to stop counting at that many files, e.g. 999 shows as 999+
+
+# Set ZSH_GIT_PROMPT_ASYNC to any non-null value to draw the prompt without waiting on git status,
+# the branch is painted first from the files under .git and the counts are filled in when git
+# status finishes, ZSH_GIT_PROMPT_TIMEOUT is how many seconds to wait before showing
+# ZSH_THEME_GIT_PROMPT_SLOW
+
+# A repository whose status took ZSH_GIT_PROMPT_SLOW_MS milliseconds (default 1000) or longer
+# ZSH_GIT_PROMPT_SLOW_RUNS times in a row (default 3) is only refreshed every ZSH_GIT_PROMPT_BACKOFF
+# seconds (default 30, 0 to always refresh) and after commands matching the zsh pattern
+# ZSH_GIT_PROMPT_BACKOFF_COMMANDS (git, make and editors by default), the prompt shows how old the
+# status is meanwhile, the first refresh faster than ZSH_GIT_PROMPT_SLOW_MS ends it
+
+# Set ZSH_GIT_PROMPT_SHARED_CACHE to any non-null value to let all shells reuse the status one of them
+# computed for a repository, until HEAD, the index or the refs change or ZSH_GIT_PROMPT_CACHE_TTL
+# seconds (default 5) pass, edits to the worktree can take that long to show
+
+# Set ZSH_GIT_PROMPT_TRACE=1 to log how long each phase of the prompt takes, in the shell and in
+# the parser, `git-super-status --timings [N]` prints p50/p95/p99 per phase over the last N prompts,
+# the log keeps the last ZSH_GIT_PROMPT_TRACE_MAX lines
+
+# Set ZSH_GIT_PROMPT_DAEMON to any non-null value to keep a status daemon running,
+# each prompt then costs one socket round trip instead of starting python
+if [[ -n "$ZSH_GIT_PROMPT_DAEMON" ]] ; then
+  git-super-status-daemon start
+fi
 
 # vim: set filetype=zsh:
@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import codecs
+import contextlib
 import datetime
+import functools
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
+import stat
 import sys
+import tempfile
 from enum import IntEnum
 
+try:
+    import fcntl
+except ImportError:
+    # not on windows, backups are copied there
+    fcntl = None
+
 LINE_SUB = 's'
 FILE_SUB = 'S'
 LINE_FIXED_SUB = 'f'
@@ -37,6 +51,19 @@ FILE_REPLACE = 'Y'
 LINE_DELETE = 'd'
 FILE_DELETE = 'D'
 ALL_FILTERS = [FILTER, LINE_FILTER, EXCLUDE, LINE_EXCLUDE, LINE_ONLY, LINE_REMOVE]
+LINE_CASE_CHANGES = [LINE_UPPER, LINE_LOWER, LINE_TITLE, LINE_CAPITALIZE]
+# line number commands, streamed unless a position or count is negative, i.e. counted from the end
+LINE_NUMBER_COMMANDS = [LINE_INSERT, LINE_REPLACE, LINE_DELETE]
+# characters of input read at a time when streaming, lines are passed between commands in batches of about this size
+BATCH_SIZE = 1 << 20
+# bytes of a file handed to a --jobs worker at a time, cut at the next line ending
+CHUNK_SIZE = 4 * BATCH_SIZE
+# line endings in UTF-8 that reading as text would translate or str.splitlines() splits on besides \n
+OTHER_LINE_ENDINGS = [b'\r', b'\x0b', b'\x0c', b'\x1c', b'\x1d', b'\x1e', b'\xc2\x85', b'\xe2\x80\xa8', b'\xe2\x80\xa9']
+# the escapes, class openings and group extensions in a pattern, see bytes_safe
+PATTERN_TOKENS = re.compile(r'\\.|\(\?.?|\[\^?|.', re.DOTALL)
+# ioctl request making a file share the data of another, from linux/fs.h
+FICLONE = 0x40049409
 
 ANSI_BLACK = '\u001b[30m'
 ANSI_RED = '\u001b[31m'
@@ -177,6 +204,31 @@ without any escaping supported or required. positions and/or counts are clamped
   $> ped -f shopping-list.txt 'd/5/1'           # delete 6th line
   $> ped -f shopping-list.txt 'd/-2/2'          # delete last two lines
 
+Large files
+
+When every command works line by line (`s`, `f`, `g`, `G`, `x`, `X`, `o`, `r`, `u`, `l`, `t`, `c`, `a`, `p` and
+`i`, `y`, `d` with positive numbers) the input is streamed through in constant memory, otherwise it is read
+whole first. When streamed input turns out not to be valid UTF-8 partway through, the output already
+written to a pipe or terminal stays there, output redirected to a file is cut back to what it was.
+
+With --jobs the lines are also split between processes when every command works within lines (all
+of the above but `a`, `p`, `i`, `y` and `d`) and --max-substitutions isn't used, the output keeps the
+input order.
+
+  $> ped -j 0 -f huge.log 'g/ERROR' 's/\\d{4}-\\d\\d-\\d\\d/DATE/'
+
+A single `S`, `R`, `O` or line filter command on a -f file with \\n line endings is run on the
+file's bytes without decoding them when its pattern is plain ASCII (no `.`, `[^...]`, \\W, \\S or \\D,
+and \\w, \\d, \\s, \\b or -i only with --ascii), the parts of the file without a match are copied
+to the output as they are. The file isn't checked for being valid UTF-8 then.
+
+In-place editing
+
+With -e the edit is written to a temporary file beside the source that replaces it once it's complete
+and synced to disk, an error leaves the source untouched. The backup is a hard link to the original
+file when the backup directory is on the same file system, else a reflink where the file system
+supports them, else a copy. A symlink is followed and the file it points to is edited.
+
 ¹ you will often want to use the --dotall option so that a dot `.` will match any
 character including line separators like \\r and \\n.
 
@@ -224,66 +276,453 @@ def main(argv):
                         default=0, help='maximum total number of substitutions per command')
     parser.add_argument('-L', '--line-max-substitutions', metavar='NUMBER', dest='maxlinesub', action='store', type=int,
                         default=0, help='maximum total number of substitutions per line (for each command)')
+    parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', action='store', type=non_negative_int, default=1,
+                        help='run line commands in N processes, 0 for one per CPU, only when every command '
+                             'works within lines and without --max-substitutions')
     parser.add_argument('--force-color', dest='color', default=None, action='store_false',
                         help="force use of ANSI color adornment even if output stream does not appear to support it")
     parser.add_argument('--no-color', dest='color', default=None, action='store_true',
                         help="disable ANSI color adornment even if output stream appears to support it")
     args = parser.parse_args(argv)
 
+    plan = compile_plan(args)
+    if args.inplace:
+        if args.path == '-':
+            raise PedError('Error: in-place editing needs a file', PedErrorTypes.PED_OTHER_ERROR)
+        # edit the file a symlink points to rather than replacing the link
+        path = os.path.realpath(args.path)
+        # the backup is only taken once the edit has been written, a failed edit leaves none
+        with replacing_file(path, functools.partial(backup_file, args, path)) as out:
+            write_output(args, plan, out)
+    elif not bytes_fast_path(args, plan):
+        with truncated_on_error(sys.stdout):
+            write_output(args, plan, sys.stdout)
+
+
+def non_negative_int(text):
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f'must be 0 or more: {value}')
+    return value
+
+
+def write_output(args, plan, out):
+    """Run the plan over the input and write the result to the text stream out"""
+    if plan and all(command.line_scoped for command in plan):
+        # nothing needs the whole file, stream it through in constant memory
+        if args.jobs != 1 and all(command.line_local for command in plan):
+            parallel_lines(args, out)
+            return
+        with (sys.stdin if args.path == '-' else open(args.path, encoding='utf-8')) as source:
+            write_batches(args, out, line_pipeline(read_batches(source), plan))
+        return
+
     contents = sys.stdin.read() if args.path == '-' else get_file_contents(args.path)
     output = get_string(args, get_lines(args, contents)) if args.normalize else contents
 
-    for item in args.commands:
-        op = item[0]
-        sep = item[1]
-        if op == FILE_SUB or op == FILE_REMOVE:
-            output = file_sub(args, output, item, op, sep)
-        elif op == FILE_ONLY:
-            output = file_only(args, output, item, op, sep)
-        elif op == LINE_SUB or op == LINE_FIXED_SUB:
-            output = line_sub(args, output, item, op, sep)
-        elif op in ALL_FILTERS:
-            output = filter_lines(args, output, item, op, sep)
-        elif op in [LINE_UPPER, LINE_LOWER, LINE_TITLE, LINE_CAPITALIZE]:
-            output = xform_lines(args, output, item, op, sep)
-        elif op in [FILE_UPPER, FILE_LOWER, FILE_TITLE, FILE_CAPITALIZE]:
-            output = xform_file(args, output, item, op, sep)
-        elif op in [LINE_APPEND, LINE_PREPEND]:
-            output = append_prepend_line(args, output, item, op, sep)
-        elif op in [FILE_APPEND, FILE_PREPEND]:
-            output = append_prepend_characters(args, output, item, op, sep)
-        elif op == LINE_INSERT:
-            output = insert_line(args, output, item, op, sep)
-        elif op == FILE_INSERT:
-            output = insert_chars(args, output, item, op, sep)
-        elif op == LINE_REPLACE:
-            output = replace_lines(args, output, item, op, sep)
-        elif op == FILE_REPLACE:
-            output = replace_chars(args, output, item, op, sep)
-        elif op == LINE_DELETE:
-            output = delete_lines(args, output, item, op, sep)
-        elif op == FILE_DELETE:
-            output = delete_chars(args, output, item, op, sep)
+    for run in command_runs(plan):
+        if run[0].line_scoped:
+            output = [line for batch in line_pipeline([get_lines(args, output)], run) for line in batch]
         else:
-            raise PedError(f'Unknown command: "{item}" from the "{item}" command', PedErrorTypes.PED_UNKNOWN_COMMAND_ERROR)
+            output = run[0].run(args, output)
+
+    out.write(get_string(args, output))
+
+
+def backup_file(args, path):
+    """
+    Keep the file at path in the backup directory before it's replaced. A hard link is tried
+    first, the edit replaces path with a new file so the link goes on holding the original,
+    then a reflink and last a copy, links can't cross file systems.
+    """
+    raw_dir = args.backup_dir[0] if isinstance(args.backup_dir, list) else args.backup_dir
+    backup_dir = os.path.expanduser(raw_dir)
+    if not os.path.isdir(backup_dir):
+        os.makedirs(backup_dir)
+    if not os.path.isdir(backup_dir):
+        raise PedError(f'Backup dir does not exist: {backup_dir}', PedErrorTypes.PED_IO_ERROR)
+    backup_name = os.path.basename(args.path)
+    ts = datetime.datetime.now().isoformat(timespec="seconds")
+    backup_name = re.sub(r'((\.[^.]+)?$)', f'-{ts}\\1', backup_name, 1)
+    backup_path = os.path.join(backup_dir, backup_name)
+    if os.path.lexists(backup_path):
+        # a backup from the same second is replaced, it may be a link to path so it's never written to
+        os.unlink(backup_path)
+    try:
+        os.link(path, backup_path)
+        return
+    except OSError:
+        pass
+    with open(path, 'rb') as src, open(backup_path, 'wb') as dst:
+        if clone_file(src, dst):
+            return
+    shutil.copyfile(path, backup_path)
+
+
+def clone_file(src, dst):
+    """
+    Make dst share the data of src, a copy on write reflink, on file systems that have them
+    (btrfs, xfs, ...).
+
+    Returns: True if it did
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def replacing_file(path, before_replace=None):
+    """
+    A text stream to a temporary file beside path that replaces path once it is written and
+    synced to disk, so path is always either the whole old file or the whole new one. The
+    temporary file is removed instead if writing it fails. before_replace is called just
+    before path is replaced.
+    """
+    path_d, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix=f'.{name}.', suffix='.ped', dir=path_d)
+    try:
+        with open(fd, 'w', encoding='utf-8') as out:
+            yield out
+            out.flush()
+            os.fsync(out.fileno())
+        copy_owner_and_mode(path, temp_path)
+        if before_replace:
+            before_replace()
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    if hasattr(os, 'O_DIRECTORY'):
+        # the rename is only durable once the directory is synced too
+        dir_fd = os.open(path_d, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+@contextlib.contextmanager
+def truncated_on_error(stream):
+    """
+    Cut a stream on a regular file back to where it was if the block raises, so a streamed
+    edit that fails partway leaves no partial output in a file stdout was redirected to.
+    What went to a pipe or terminal can't be taken back.
+    """
+    try:
+        stream.flush()
+        fd = stream.fileno()
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            start = None
+        elif fcntl and fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND:
+            # `>>`, every write goes to the end wherever the offset is
+            start = st.st_size
+        else:
+            start = os.lseek(fd, 0, os.SEEK_CUR)
+    except (OSError, ValueError):
+        start = None
+    try:
+        yield
+    except BaseException:
+        if start is not None:
+            stream.flush()
+            os.ftruncate(fd, start)
+            os.lseek(fd, start, os.SEEK_SET)
+        raise
 
-    if args.inplace:
-        raw_dir = args.backup_dir[0] if isinstance(args.backup_dir, list) else args.backup_dir
-        backup_dir = os.path.expanduser(raw_dir)
-        if not os.path.isdir(backup_dir):
-            os.makedirs(backup_dir)
-        if not os.path.isdir(backup_dir):
-            raise PedError(f'Backup dir does not exist: {backup_dir}', PedErrorTypes.PED_IO_ERROR)
-        backup_name = os.path.basename(args.path)
-        ts = datetime.datetime.now().isoformat(timespec="seconds")
-        backup_name = re.sub(r'((\.[^.]+)?$)', f'-{ts}\\1', backup_name, 1)
-        backup_path = os.path.join(backup_dir, backup_name)
-        with open(backup_path, 'w', encoding='utf-8') as f:
-            f.write(contents)
-        with open(args.path, 'w', encoding='utf-8') as f:
-            f.write(get_string(args, output))
+
+def copy_owner_and_mode(path, temp_path):
+    st = os.stat(path)
+    os.chmod(temp_path, stat.S_IMODE(st.st_mode))
+    if hasattr(os, 'chown') and (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+        try:
+            os.chown(temp_path, st.st_uid, st.st_gid)
+        except PermissionError:
+            # only root can give a file away, the edited file stays ours
+            pass
+
+
+def compile_plan(args):
+    """Parse every COMMAND and compile its pattern once, before any input is read"""
+    return [compile_command(args, item) for item in args.commands]
+
+
+def compile_command(args, item):
+    op = item[:1]
+    if op in [LINE_SUB, LINE_FIXED_SUB] + LINE_CASE_CHANGES:
+        return SubstituteCommand(args, item)
+    if op in ALL_FILTERS:
+        return FilterCommand(args, item)
+    if op in [LINE_APPEND, LINE_PREPEND]:
+        return AppendPrependCommand(args, item)
+    if op in LINE_NUMBER_COMMANDS:
+        command = SpliceCommand(args, item)
+        if command.start >= 0 and command.count >= 0:
+            return command
+    return FileCommand(args, item)
+
+
+def compile_pattern(args, e, fixed=False):
+    flags = args.insensitive | args.multiline | args.ascii | args.dotall
+    return re.compile(re.escape(e) if args.fixed or fixed else e, flags)
+
+
+def command_runs(plan):
+    """Split the plan into runs of consecutive line scoped commands and single whole file commands"""
+    runs = []
+    for command in plan:
+        if runs and command.line_scoped and runs[-1][0].line_scoped:
+            runs[-1].append(command)
+        else:
+            runs.append([command])
+    return runs
+
+
+def line_pipeline(batches, commands):
+    """
+    Chain the generators of line scoped commands, each one takes and yields lists of lines so only
+    a batch of lines is held at a time and nothing is read until the result is iterated
+    """
+    for command in commands:
+        batches = command.stream(batches)
+    return batches
+
+
+def parallel_lines(args, out):
+    """
+    Stream the input through a process pool running the plan, the file in line aligned
+    byte ranges of a memory map, stdin in batches, the results are written in order
+    """
+    with multiprocessing.Pool(args.jobs or None, init_worker, (args,)) as pool:
+        if args.path == '-':
+            chunks = read_batches(sys.stdin)
+        else:
+            chunks = ((args.path, start, end) for start, end in line_ranges(args.path, CHUNK_SIZE))
+        results = pool.imap(run_chunk, chunks)
+        write_batches(args, out, ([text] if lines else [] for text, lines in results))
+
+
+def line_ranges(path, size):
+    """The (start, end) byte ranges of about size bytes that path splits into, each ending after a line ending"""
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from buffer_line_ranges(data, size)
+
+
+def buffer_line_ranges(data, size):
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + size) + 1 or len(data)
+        yield start, end
+        start = end
+
+
+def bytes_fast_path(args, plan):
+    """
+    Run a lone `S`, `R`, `O` or line filter command on a memory map of the file with a bytes
+    pattern, without decoding it, when that gives the same output: the pattern is bytes_safe,
+    the file has no line endings but \n and the output is UTF-8. Unchanged parts of the file
+    are written straight from the map.
+
+    Returns: True if the command ran
+    """
+    if args.path == '-' or args.inplace or args.normalize or len(plan) != 1 or os.linesep != '\n':
+        return False
+    op = plan[0].op
+    item = plan[0].item
+    if op not in [FILE_SUB, FILE_REMOVE, FILE_ONLY] + ALL_FILTERS or op in ALL_FILTERS and args.ending != '\n':
+        return False
+    encoding = getattr(sys.stdout, 'encoding', None)
+    if not hasattr(sys.stdout, 'buffer') or not encoding or codecs.lookup(encoding).name != 'utf-8':
+        return False
+    if op == FILE_SUB:
+        e, r = param_str_str(item, plan[0].sep)
     else:
-        sys.stdout.write(get_string(args, output))
+        e, r = param_str(item, plan[0].sep), ''
+    e = re.escape(e) if args.fixed else e
+    same, line_local, anchors = bytes_safe(args, e)
+    if not same or op in ALL_FILTERS and (not line_local or anchors - {'^', '$'}):
+        # filters search a whole range of lines first, where \A and \Z are the ends of the
+        # range rather than of each line and \b and \B differ on empty lines
+        return False
+    flags = args.insensitive | args.multiline | args.dotall | (re.MULTILINE if op in ALL_FILTERS else 0)
+    pattern = re.compile(e.encode('ascii'), flags)
+    if pattern.match('é'.encode('utf-8'), 1):
+        # an empty match can fall between the bytes of a character, e.g. `a*` or \B
+        return False
+
+    with open(args.path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # a find per ending is many times faster than one regexp search for any of them, and
+            # a find for the last byte alone faster again, the whole ending is looked for only after it
+            endings = OTHER_LINE_ENDINGS if op in ALL_FILTERS else OTHER_LINE_ENDINGS[:1]
+            if any(data.find(ending[-1:]) >= 0 and data.find(ending) >= 0 for ending in endings):
+                return False
+            sys.stdout.flush()
+            out = sys.stdout.buffer
+            if op in ALL_FILTERS:
+                filter_bytes(args, op, pattern, data, out)
+            elif op == FILE_ONLY:
+                out.writelines(match[0] for match in pattern.finditer(data))
+            elif line_local and not anchors and not pattern.match(b''):
+                # no match can cross a line ending, so the map can be taken a range at a time
+                sub_bytes(args, pattern, r.encode('utf-8'), data, out)
+            else:
+                out.write(pattern.sub(r.encode('utf-8'), data, count=args.maxsub))
+            out.flush()
+    return True
+
+
+def bytes_safe(args, e):
+    """
+    Check pattern e for bytes_fast_path, it matches the same in UTF-8 bytes as in str when it
+    is ASCII and has nothing that can match a part of a multibyte character (`.`, `[^`, \\W,
+    \\S, \\D and code point escapes), no lookarounds or inline flags, and \\w, \\d, \\s, \\b,
+    \\B or case folding only with -a, where they are ASCII only for str too.
+
+    Returns: (matches the same, can't match a line ending, the set of the ^ $ A Z b B anchors in it)
+    """
+    if not e.isascii() or args.insensitive and not args.ascii:
+        return False, False, set()
+    line_local = True
+    anchors = set()
+    in_class = False
+    for token in PATTERN_TOKENS.findall(e):
+        if token in ['.', '[^'] or token.startswith('(?') and token[2:] not in [':', 'P']:
+            return False, False, set()
+        if token[0] == '\\' and len(token) == 2:
+            if token[1] in 'WSDxuUN0123456789' or token[1] in 'wdsbB' and not args.ascii:
+                return False, False, set()
+            if token[1] in 'snrfv' or in_class and token[1].isalpha() and token[1] not in 'wd':
+                # \s, \n and the like, or the end of a range that could span \n
+                line_local = False
+            if token[1] in 'AZbB':
+                anchors.add(token[1])
+        elif token in ['^', '$']:
+            anchors.add(token)
+        elif token == '\n' or in_class and token < ' ':
+            line_local = False
+        if token == '[':
+            in_class = True
+        elif token == ']':
+            in_class = False
+    return True, line_local, anchors
+
+
+def sub_bytes(args, pattern, replacement, data, out):
+    """Substitute in data a range at a time, ranges without a match are written as they are"""
+    left = args.maxsub
+    with memoryview(data) as view:
+        for start, end in buffer_line_ranges(data, BATCH_SIZE):
+            chunk = view[start:end]
+            if args.maxsub and left <= 0 or not pattern.search(chunk):
+                out.write(chunk)
+                continue
+            text, count = pattern.subn(replacement, chunk, count=max(left, 0))
+            left -= count
+            out.write(text)
+
+
+def filter_bytes(args, op, pattern, data, out):
+    """
+    The line filter op on data a range at a time, ranges without a match are skipped or
+    written as they are without splitting them into lines
+    """
+    with memoryview(data) as view:
+        write_filtered_bytes(args, op, pattern, data, view, out)
+
+
+def write_filtered_bytes(args, op, pattern, data, view, out):
+    if op in [LINE_FILTER, LINE_EXCLUDE]:
+        pattern = re.compile(b'^(?:' + pattern.pattern + b')$', pattern.flags)
+    search = pattern.search
+    # the last output is held back to end it as join_lines would
+    pending = None
+    for start, end in buffer_line_ranges(data, BATCH_SIZE):
+        chunk = view[start:end]
+        if not search(chunk):
+            output = chunk if op in [EXCLUDE, LINE_EXCLUDE, LINE_REMOVE] else None
+        else:
+            lines = bytes(chunk).splitlines()
+            if op in [FILTER, LINE_FILTER]:
+                lines = list(filter(search, lines))
+            elif op in [EXCLUDE, LINE_EXCLUDE]:
+                lines = [line for line in lines if not search(line)]
+            elif op == LINE_ONLY:
+                lines = [b''.join(matches) for matches in
+                         ([match[0] for match in pattern.finditer(line)] for line in lines) if matches]
+            else:
+                lines = [pattern.sub(b'', line) for line in lines]
+            output = b'\n'.join(lines) + b'\n' if lines else None
+        if output:
+            if pending:
+                out.write(pending)
+            pending = output
+    if pending:
+        out.write(pending[:-1] if pending[-1] == 10 else pending)
+        if args.eof:
+            out.write(b'\n')
+
+
+# The plan a --jobs worker process runs, see init_worker
+WORKER_PLAN = None
+WORKER_ENDING = None
+
+
+def init_worker(args):
+    global WORKER_PLAN, WORKER_ENDING
+    WORKER_PLAN = compile_plan(args)
+    WORKER_ENDING = args.ending
+
+
+def run_chunk(chunk):
+    """
+    Run the plan in a worker on a (path, start, end) range of a file or on a batch of lines.
+
+    Returns: (the resulting lines joined, True if there were any)
+    """
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunk = data[start:end].decode('utf-8').splitlines()
+    lines = [line for batch in line_pipeline([chunk], WORKER_PLAN) for line in batch]
+    return WORKER_ENDING.join(lines), bool(lines)
+
+
+def read_batches(stream):
+    """The lines of a text stream as get_lines would split them, in batches of about BATCH_SIZE"""
+    while True:
+        lines = stream.readlines(BATCH_SIZE)
+        if not lines:
+            break
+        yield ''.join(lines).splitlines()
+
+
+def write_batches(args: argparse.Namespace, stream, batches):
+    """Write batches of lines as join_lines would join all of their lines"""
+    written = False
+    for lines in batches:
+        if lines:
+            if written:
+                stream.write(args.ending)
+            stream.write(args.ending.join(lines))
+            written = True
+    if written and args.eof:
+        stream.write(args.ending)
+
+
+def split_new_lines(text):
+    """Lines of text added by a command, embedded line endings start new lines"""
+    return (text + '\n').splitlines() if '\n' in text else [text]
 
 
 def join_lines(args: argparse.Namespace, lines):
@@ -385,16 +824,6 @@ def delete_chars(args, data, item, _op, sep='/'):
     return buf[:start] + buf[start + count:]
 
 
-def append_prepend_line(args, data, item, op, sep='/'):
-    lines = get_lines(args, data)
-    string = param_str(item, sep)
-    if op == LINE_APPEND:
-        lines.append(string)
-    else:
-        lines.insert(0, string)
-    return get_normalized_lines(args, lines) if '\n' in string else lines
-
-
 def append_prepend_characters(args, data, item, op, sep='/'):
     string = param_str(item, sep)
     if op == FILE_APPEND:
@@ -409,94 +838,23 @@ def xform_file(args, data, item, op, sep='/'):
     return re.sub(e, lambda m: xform(m, op), data, count=args.maxsub, flags=flags)
 
 
-def xform_lines(args, data, item, op, sep='/'):
-    lines = get_lines(args, data)
-    flags = args.insensitive | args.multiline | args.ascii | args.dotall
-    e = param_str(item, sep)
-    e = re.escape(e) if args.fixed else e
-    if args.maxsub > 0:
-        maxsub = args.maxsub
-        for i, line in enumerate(lines):
-            subs = maxsub if args.maxlinesub == 0 else min(maxsub, args.maxlinesub)
-            lines[i], count = re.subn(e, lambda m: xform(m, op), line, count=subs, flags=flags)
-            maxsub -= count
-            if maxsub <= 0:
-                break
-        return lines
-    else:
-        return [re.sub(e, lambda m: xform(m, op), line, flags=flags) for line in lines]
+def xform(match, op):
+    return case_change(op)(match[0])
 
 
-def xform(match, op):
+def case_change(op):
     if op == 'u' or op == 'U':
-        return match[0].upper()
+        return str.upper
     elif op == 'l' or op == 'L':
-        return match[0].lower()
+        return str.lower
     elif op == 't' or op == 'T':
-        return match[0].title()
+        return str.title
     elif op == 'c' or op == 'C':
-        return match[0].capitalize()
+        return str.capitalize
     else:
         raise ValueError(f'Unknown command: "{op}"')
 
 
-def filter_lines(args, data, item, op, sep='/'):
-    flags = args.insensitive | args.multiline | args.ascii | args.dotall
-    e = param_str(item, sep)
-    e = re.escape(e) if args.fixed else e
-    output = []
-    for line in get_lines(args, data):
-        if op == FILTER:
-            if re.search(e, line, flags=flags):
-                output.append(line)
-        elif op == LINE_FILTER:
-            if re.fullmatch(e, line, flags=flags):
-                output.append(line)
-        elif op == EXCLUDE:
-            if not re.search(e, line, flags=flags):
-                output.append(line)
-        elif op == LINE_EXCLUDE:
-            if not re.fullmatch(e, line, flags=flags):
-                output.append(line)
-        elif op == LINE_ONLY:
-            matches = list(re.finditer(e, line, flags=flags))
-            if len(matches):
-                output.append(''.join([match[0] for match in matches]))
-        elif op == LINE_REMOVE:
-            output.append(re.sub(e, '', line, flags=flags))
-        else:
-            raise ValueError(f'Unknown command: "{op}" from the "{item}" command')
-    return output
-
-
-def line_sub(args, data, item, op, sep='/'):
-    resplit = False
-    lines = get_lines(args, data)
-    flags = args.insensitive | args.multiline | args.ascii | args.dotall
-    e, r = param_str_str(item, sep)
-    e = re.escape(e) if args.fixed or op == LINE_FIXED_SUB else e
-    if args.maxsub > 0:
-        maxsub = args.maxsub
-        for i, line in enumerate(lines):
-            subs = maxsub if args.maxlinesub == 0 else min(maxsub, args.maxlinesub)
-            lines[i], count = re.subn(e, r, line, count=subs, flags=flags)
-            maxsub -= count
-            if count:
-                if '\n' in lines[i]:
-                    resplit = True
-            if maxsub <= 0:
-                break
-        return get_normalized_lines(args, lines) if resplit else lines
-    else:
-        resplit = False
-        new_lines = []
-        for line in lines:
-            new_lines.append(new_line := re.sub(e, r, line, count=args.maxlinesub, flags=flags))
-            resplit = resplit or '\n' in new_line
-        return get_normalized_lines(args, new_lines) if resplit else new_lines
-        # return [re.sub(e, r, line, count=args.maxlinesub, flags=flags) for line in lines]
-
-
 def file_sub(args, data, item, op, sep='/'):
     flags = args.insensitive | args.multiline | args.ascii | args.dotall
     if op == FILE_REMOVE:
@@ -526,6 +884,179 @@ def get_file_contents(path):
     return data
 
 
+class Command:
+    """
+    A COMMAND parsed once up front. Line scoped commands hold their compiled pattern and
+    the callable run on every line and define stream(batches), which takes and yields
+    batches of lines. The others define run(args, data) on the whole buffer.
+    """
+    line_scoped = True
+    # the result for a line only depends on the line, so the lines can be split between processes
+    line_local = False
+
+    def __init__(self, _args, item):
+        self.item = item
+        self.op = item[0]
+        self.sep = item[1]
+
+
+class SubstituteCommand(Command):
+    """`s`, `f` and the case changes `u`, `l`, `t`, `c`"""
+
+    def __init__(self, args, item):
+        super().__init__(args, item)
+        if self.op in LINE_CASE_CHANGES:
+            e = param_str(item, self.sep)
+            change = case_change(self.op)
+            self.replacement = lambda match: change(match[0])
+            line_max = 0
+        else:
+            e, self.replacement = param_str_str(item, self.sep)
+            line_max = args.maxlinesub
+        self.pattern = compile_pattern(args, e, self.op == LINE_FIXED_SUB)
+        self.each = functools.partial(self.pattern.sub, self.replacement, count=line_max)
+        self.maxsub = args.maxsub
+        self.maxlinesub = args.maxlinesub
+        # --max-substitutions counts across all lines
+        self.line_local = self.maxsub <= 0
+        # only a replacement with a line ending or an escape can add line endings, the lines themselves have none
+        self.resplit = isinstance(self.replacement, str) and ('\n' in self.replacement or '\\' in self.replacement)
+
+    def stream(self, batches):
+        maxsub = self.maxsub
+        each = self.each
+        for lines in batches:
+            if self.maxsub > 0:
+                # the limit counts across lines
+                lines = list(lines)
+                for i, line in enumerate(lines):
+                    if maxsub <= 0:
+                        break
+                    subs = maxsub if self.maxlinesub == 0 else min(maxsub, self.maxlinesub)
+                    lines[i], count = self.pattern.subn(self.replacement, line, count=subs)
+                    maxsub -= count
+            else:
+                lines = [each(line) for line in lines]
+            if self.resplit:
+                # a replacement with line endings makes more lines
+                lines = [new_line for line in lines for new_line in split_new_lines(line)]
+            yield lines
+
+
+class FilterCommand(Command):
+    """The line filters `g`, `G`, `x`, `X`, `o` and `r`"""
+    line_local = True
+
+    def __init__(self, args, item):
+        super().__init__(args, item)
+        self.pattern = compile_pattern(args, param_str(item, self.sep))
+        if self.op in [FILTER, EXCLUDE]:
+            self.each = self.pattern.search
+        elif self.op in [LINE_FILTER, LINE_EXCLUDE]:
+            self.each = self.pattern.fullmatch
+        elif self.op == LINE_ONLY:
+            self.each = self.only
+        else:
+            self.each = functools.partial(self.pattern.sub, '')
+
+    def only(self, line):
+        matches = [match[0] for match in self.pattern.finditer(line)]
+        return ''.join(matches) if matches else None
+
+    def stream(self, batches):
+        each = self.each
+        for lines in batches:
+            if self.op in [FILTER, LINE_FILTER]:
+                yield [line for line in lines if each(line)]
+            elif self.op in [EXCLUDE, LINE_EXCLUDE]:
+                yield [line for line in lines if not each(line)]
+            elif self.op == LINE_ONLY:
+                yield [line for line in map(each, lines) if line is not None]
+            else:
+                yield [each(line) for line in lines]
+
+
+class AppendPrependCommand(Command):
+    """`a` and `p`"""
+
+    def __init__(self, args, item):
+        super().__init__(args, item)
+        self.new_lines = split_new_lines(param_str(item, self.sep))
+
+    def stream(self, batches):
+        if self.op == LINE_PREPEND:
+            yield self.new_lines
+        yield from batches
+        if self.op == LINE_APPEND:
+            yield self.new_lines
+
+
+class SpliceCommand(Command):
+    """`i`, `y` and `d`, replacing count lines from line number start with new_lines"""
+
+    def __init__(self, args, item):
+        super().__init__(args, item)
+        if self.op == LINE_INSERT:
+            self.start, text = param_num_str(item, self.sep)
+            self.count = 0
+            self.new_lines = split_new_lines(text)
+        elif self.op == LINE_REPLACE:
+            self.start, self.count, text = param_num_num_str(item, self.sep)
+            self.new_lines = text.splitlines()
+        else:
+            self.start, self.count = param_num_num(item, self.sep)
+            self.new_lines = []
+
+    def stream(self, batches):
+        start, end = self.start, self.start + self.count
+        offset = 0
+        for lines in batches:
+            size = len(lines)
+            if offset + size > start and offset < end or offset <= start < offset + size:
+                low = min(max(start - offset, 0), size)
+                high = min(max(end - offset, 0), size)
+                lines = lines[:low] + (self.new_lines if offset <= start else []) + lines[high:]
+            offset += size
+            yield lines
+        # fewer lines than start, the new lines go at the end
+        if offset <= start:
+            yield self.new_lines
+
+
+class FileCommand(Command):
+    """Commands that need the whole buffer"""
+    line_scoped = False
+
+    def __init__(self, args, item):
+        super().__init__(args, item)
+        op = self.op
+        if op == FILE_SUB or op == FILE_REMOVE:
+            self.function = file_sub
+        elif op == FILE_ONLY:
+            self.function = file_only
+        elif op in [FILE_UPPER, FILE_LOWER, FILE_TITLE, FILE_CAPITALIZE]:
+            self.function = xform_file
+        elif op in [FILE_APPEND, FILE_PREPEND]:
+            self.function = append_prepend_characters
+        elif op == LINE_INSERT:
+            self.function = insert_line
+        elif op == FILE_INSERT:
+            self.function = insert_chars
+        elif op == LINE_REPLACE:
+            self.function = replace_lines
+        elif op == FILE_REPLACE:
+            self.function = replace_chars
+        elif op == LINE_DELETE:
+            self.function = delete_lines
+        elif op == FILE_DELETE:
+            self.function = delete_chars
+        else:
+            raise PedError(f'Unknown command: "{item}" from the "{item}" command', PedErrorTypes.PED_UNKNOWN_COMMAND_ERROR)
+
+    def run(self, args, data):
+        return self.function(args, data, self.item, self.op, self.sep)
+
+
 class CustomFormatter(argparse.HelpFormatter):
     # noinspection PyMethodMayBeStatic
     def _flow(self, text):
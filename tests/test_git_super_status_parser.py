@@ -0,0 +1,292 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+HERE_D = os.path.dirname(os.path.abspath(__file__))
+PARSER_FILE = os.path.join(HERE_D, '..', 'git-super-status-parser.py')
+
+spec = importlib.util.spec_from_file_location('git_super_status_parser', PARSER_FILE)
+parser = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(parser)
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com',
+               GIT_CONFIG_NOSYSTEM='1', GIT_CONFIG_GLOBAL=os.devnull)
+
+
+def git(repo_d, *args, **kwargs):
+    input_file = kwargs.get('input_file')
+    with open(str(input_file), 'rb') if input_file else open(os.devnull, 'rb') as stdin:
+        return subprocess.run(('git',) + args, cwd=str(repo_d), env=GIT_ENV, check=True, stdin=stdin,
+                              stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+
+
+def count(data, chunk_size=7, **kwargs):
+    counter = parser.StatusCounter(**kwargs)
+    for start in range(0, len(data), chunk_size):
+        counter.feed(data[start:start + chunk_size])
+    counter.finish()
+    return counter
+
+
+V2_Z = (b'# branch.oid 1234\0# branch.head main\0# branch.upstream origin/main\0# branch.ab +2 -1\0'
+        b'2 R. N... 100644 100644 100644 1111 1111 R100 new name\0old name\0'
+        b'2 RM N... 100644 100644 100644 1111 1111 R90 moved\x002 R. N... fake\0'
+        b'1 .M N... 100644 100644 100644 1111 1111 changed\0'
+        b'u UU N... 100644 100644 100644 100644 1111 2222 3333 conflicted\0'
+        b'? untracked\0')
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, len(V2_Z)])
+def test_v2_z_rename_records_skip_their_original_path(chunk_size):
+    # the original path of a rename is a record of its own, even one that looks like a record
+    counter = count(V2_Z, chunk_size)
+    assert counter.stats() == (2, 1, 2, 1)
+    assert counter.branch(None) == ('main', 'origin/main', 0, 2, 1)
+
+
+def test_v2_lines_keep_the_original_path_on_the_record():
+    data = V2_Z.replace(b'name\0old', b'name\told').replace(b'moved\0', b'moved\t').replace(b'\0', b'\n')
+    assert count(data).stats() == (2, 1, 2, 1)
+
+
+def test_v2_z_submodule_and_header_records():
+    data = (b'# branch.oid 1234\0# branch.head main\0'
+            b'1 .M SCM. 160000 160000 160000 1111 1111 sub\0'
+            b'1 .M S..U 160000 160000 160000 1111 1111 other\0'
+            b'1 .M SC.. 160000 160000 160000 1111 1111 moved\0')
+    counter = count(data)
+    assert counter.submodules_dirty == 2
+    assert counter.headers == {'branch.oid': '1234', 'branch.head': 'main'}
+
+
+def test_v1_output_is_still_counted():
+    counter = count(b'## main...origin/main [ahead 1]\nM  staged\n M changed\n?? new\n')
+    assert counter.stats() == (1, 0, 1, 1)
+
+
+def test_git_status_z_output(tmp_path):
+    git(tmp_path, 'init', '-q', '-b', 'main')
+    for name in ('a b', 'c', 'd'):
+        (tmp_path / name).write_text(name * 50 + '\n')
+    git(tmp_path, 'add', '-A')
+    git(tmp_path, 'commit', '-q', '-m', 'base')
+    git(tmp_path, 'mv', 'a b', 'renamed a b')
+    (tmp_path / 'c').write_text('changed\n')
+    (tmp_path / 'e').write_text('new\n')
+    status = subprocess.run(['git', 'status', '--porcelain=v2', '--branch', '-z'], cwd=str(tmp_path),
+                            env=GIT_ENV, stdout=subprocess.PIPE, check=True).stdout
+    counter = count(status, 5)
+    assert counter.stats() == (1, 0, 1, 1)
+    assert counter.branch(None)[0] == 'main'
+
+
+NAMES = ['a', 'dir/file', 'dir/file two', 'dir/sub/deeper', 'dir2/é']
+
+
+def make_index_repo(repo_d, object_format, version):
+    git(repo_d, 'init', '-q', '--object-format=' + object_format)
+    for name in NAMES:
+        path = repo_d / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name * 3 + '\n')
+        # older than the index, so no entry is racily clean
+        os.utime(str(path), (1000000000, 1000000000))
+    git(repo_d, 'add', '-A')
+    git(repo_d, 'update-index', '--index-version', str(version))
+    return repo_d / '.git' / 'index'
+
+
+@pytest.mark.parametrize('object_format', ['sha1', 'sha256'])
+@pytest.mark.parametrize('version', [2, 3, 4])
+def test_index_stat_entries(tmp_path, object_format, version):
+    index_file = make_index_repo(tmp_path, object_format, version)
+    oid_len = parser.oid_length(str(tmp_path / '.git'))
+    assert oid_len == (32 if object_format == 'sha256' else 20)
+    index_stat = parser.IndexStat(str(index_file), str(tmp_path), oid_len)
+    assert index_stat.paths == [os.path.join(str(tmp_path), name) for name in NAMES]
+    assert list(index_stat.sizes) == [len(name.encode('utf-8')) * 3 + 1 for name in NAMES]
+    assert index_stat.files_unchanged()
+
+    (tmp_path / 'dir' / 'file two').write_text('edited\n')
+    assert not index_stat.files_unchanged()
+
+
+@pytest.mark.parametrize('object_format', ['sha1', 'sha256'])
+@pytest.mark.parametrize('version', [2, 3, 4])
+def test_read_index_gitlinks(tmp_path, object_format, version):
+    index_file = make_index_repo(tmp_path, object_format, version)
+    oid = git(tmp_path, 'hash-object', '-w', str(tmp_path / 'a'))
+    for path in ('dir/mod', 'dir/sub/mod'):
+        git(tmp_path, 'update-index', '--add', '--cacheinfo', '160000,{0},{1}'.format(oid, path))
+    gitlinks = parser.read_index_gitlinks(str(index_file), ['dir/mod', 'dir/sub/mod', 'missing'],
+                                          parser.oid_length(str(tmp_path / '.git')))
+    assert gitlinks == {'dir/mod': oid, 'dir/sub/mod': oid}
+
+
+def commit(repo_d, message, *parents):
+    tree = git(repo_d, 'mktree')
+    args = ['commit-tree', tree, '-m', message]
+    for parent in parents:
+        args += ['-p', parent]
+    return git(repo_d, *args)
+
+
+def make_history(repo_d):
+    """
+    A base line of commits with a branch and an upstream that both moved on
+    from it, the upstream merging a side branch of its own on the way.
+
+    Returns: (branch tip, upstream tip)
+    """
+    git(repo_d, 'init', '-q', '-b', 'main')
+    base = commit(repo_d, 'base')
+    for i in range(5):
+        base = commit(repo_d, 'base {0}'.format(i), base)
+    local = base
+    for i in range(3):
+        local = commit(repo_d, 'local {0}'.format(i), local)
+    upstream = commit(repo_d, 'upstream', base)
+    side = commit(repo_d, 'side', base)
+    upstream = commit(repo_d, 'merge', upstream, side)
+    upstream = commit(repo_d, 'upstream 2', upstream)
+    git(repo_d, 'update-ref', 'refs/heads/main', local)
+    git(repo_d, 'update-ref', 'refs/heads/upstream', upstream)
+    return local, upstream
+
+
+def expected_ahead_behind(repo_d, local, upstream):
+    ahead, behind = git(repo_d, 'rev-list', '--left-right', '--count', local + '...' + upstream).split()
+    return int(ahead), int(behind)
+
+
+@pytest.mark.parametrize('store', ['loose', 'graph', 'split-graph', 'graph-then-loose', 'pack'])
+def test_ahead_behind(tmp_path, store):
+    local, upstream = make_history(tmp_path)
+    if store == 'graph':
+        git(tmp_path, 'commit-graph', 'write', '--reachable')
+    elif store == 'split-graph':
+        git(tmp_path, 'commit-graph', 'write', '--split', '--reachable')
+        local = commit(tmp_path, 'newer', local)
+        git(tmp_path, 'update-ref', 'refs/heads/main', local)
+        git(tmp_path, 'commit-graph', 'write', '--split', '--reachable')
+    elif store == 'graph-then-loose':
+        git(tmp_path, 'commit-graph', 'write', '--reachable')
+        upstream = commit(tmp_path, 'newer', upstream)
+    elif store == 'pack':
+        # no delta window, a deltified commit makes the walk give up
+        git(tmp_path, 'repack', '-a', '-d', '-q', '--window=0')
+        assert not os.path.exists(str(tmp_path / '.git' / 'objects' / 'info' / 'commit-graph'))
+    reader = parser.CommitReader(str(tmp_path / '.git' / 'objects'))
+    if 'graph' in store:
+        assert reader.graphs
+    assert parser.ahead_behind(reader, local, upstream) == expected_ahead_behind(tmp_path, local, upstream)
+    assert parser.ahead_behind(reader, local, local) == (0, 0)
+
+
+@pytest.mark.parametrize('graph', [False, True])
+def test_ahead_behind_with_tied_commit_times(tmp_path, monkeypatch, graph):
+    # a merge and its child made in the same second, found before the merge's parents are reached
+    monkeypatch.setitem(GIT_ENV, 'GIT_COMMITTER_DATE', '1600000000 +0000')
+    git(tmp_path, 'init', '-q', '-b', 'main')
+    base = commit(tmp_path, 'base')
+    local = commit(tmp_path, 'merge', base, commit(tmp_path, 'side', base))
+    upstream = commit(tmp_path, 'upstream', local)
+    if graph:
+        git(tmp_path, 'update-ref', 'refs/heads/main', upstream)
+        git(tmp_path, 'commit-graph', 'write', '--reachable')
+    reader = parser.CommitReader(str(tmp_path / '.git' / 'objects'))
+    assert parser.ahead_behind(reader, local, upstream) == (0, 1)
+    assert parser.ahead_behind(reader, upstream, local) == (1, 0)
+
+
+@pytest.mark.parametrize('graph', [False, True])
+def test_ahead_behind_with_skewed_commit_times(tmp_path, monkeypatch, graph):
+    def dated_commit(when, *parents):
+        monkeypatch.setitem(GIT_ENV, 'GIT_COMMITTER_DATE', '{0} +0000'.format(1600000000 + when))
+        return commit(tmp_path, str(when), *parents)
+
+    git(tmp_path, 'init', '-q', '-b', 'main')
+    base = dated_commit(0)
+    local = dated_commit(150, base)
+    # committed on a clock running 100s behind its parent's
+    upstream = dated_commit(100, dated_commit(200, base))
+    if graph:
+        git(tmp_path, 'update-ref', 'refs/heads/main', local)
+        git(tmp_path, 'update-ref', 'refs/heads/upstream', upstream)
+        git(tmp_path, 'commit-graph', 'write', '--reachable')
+    reader = parser.CommitReader(str(tmp_path / '.git' / 'objects'))
+    # without generation numbers the skew makes the walk leave it to git
+    assert parser.ahead_behind(reader, local, upstream) == ((1, 2) if graph else None)
+    assert expected_ahead_behind(tmp_path, local, upstream) == (1, 2)
+
+
+def test_ahead_behind_gives_up_at_the_limit(tmp_path):
+    local, upstream = make_history(tmp_path)
+    reader = parser.CommitReader(str(tmp_path / '.git' / 'objects'))
+    assert parser.ahead_behind(reader, local, upstream, limit=3) is None
+
+
+def test_pack_index_offsets(tmp_path):
+    local, upstream = make_history(tmp_path)
+    git(tmp_path, 'repack', '-a', '-d', '-q', '--window=0')
+    pack_d = tmp_path / '.git' / 'objects' / 'pack'
+    idx_file, = [name for name in os.listdir(str(pack_d)) if name.endswith('.idx')]
+    index = parser.PackIndex(str(pack_d / idx_file))
+    listed = git(tmp_path, 'show-index', input_file=pack_d / idx_file)
+    for line in listed.splitlines():
+        offset, oid = line.split()[:2]
+        assert index.offset(bytes.fromhex(oid)) == int(offset)
+    assert index.offset(b'\0' * 20) is None
+    assert index.offset(b'\xff' * 20) is None
+
+
+def wait_for(predicate, timeout=5):
+    give_up = time.time() + timeout
+    while not predicate():
+        assert time.time() < give_up
+        time.sleep(0.01)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_status_cache_drops_an_entry_on_a_worktree_edit(tmp_path):
+    git(tmp_path, 'init', '-q', '-b', 'main')
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'tracked').write_text('x\n')
+    git(tmp_path, 'add', '-A')
+    git(tmp_path, 'commit', '-q', '-m', 'base')
+    git_root = str(tmp_path / '.git')
+    cache = parser.StatusCache(parser.InotifyWatcher())
+    _, signature = cache.lookup(git_root)
+    cache.store(git_root, signature, 'clean')
+    wait_for(lambda: cache.watcher.watching(str(tmp_path)))
+    # the signature now says the worktree is watched, store again under it
+    _, signature = cache.lookup(git_root)
+    cache.store(git_root, signature, 'clean')
+    assert cache.lookup(git_root)[0] == 'clean'
+
+    (tmp_path / 'dir' / 'tracked').write_text('edited\n')
+    wait_for(lambda: cache.lookup(git_root)[0] is None)
+
+
+def test_find_repos_searches_worktrees_for_submodules_only(tmp_path):
+    for repo in ('lib', 'plain/repo', 'super', 'super/node_modules/dep'):
+        (tmp_path / repo).mkdir(parents=True)
+        git(tmp_path / repo, 'init', '-q', '-b', 'main')
+    git(tmp_path / 'lib', 'commit', '-q', '--allow-empty', '-m', 'lib')
+    git(tmp_path / 'super', '-c', 'protocol.file.allow=always', 'submodule', 'add', '-q',
+        str(tmp_path / 'lib'), 'libs/nested/lib')
+    assert list(parser.find_repos(str(tmp_path))) == [
+        str(tmp_path / name) for name in ('lib', 'plain/repo', 'super', 'super/libs/nested/lib')]
+
+
+@pytest.mark.parametrize('jobs', ['-1', 'many'])
+def test_scan_rejects_bad_jobs_with_a_usage_error(tmp_path, jobs):
+    run = subprocess.run([sys.executable, PARSER_FILE, '--scan', str(tmp_path), '--jobs', jobs],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert run.returncode == 2
+    assert b'usage:' in run.stderr and b'Traceback' not in run.stderr
@@ -0,0 +1,108 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+HERE_D = os.path.dirname(os.path.abspath(__file__))
+PED = os.path.join(HERE_D, '..', 'ped.py')
+sys.path.insert(0, os.path.join(HERE_D, '..'))
+
+import ped  # noqa: E402
+
+TEXT = 'bar\nfoo\nfoox\n\n-x foo\nfoo bar\nhéllo foo\nlast foo'
+
+
+def run_ped(args, stdin=None):
+    return subprocess.run([sys.executable, PED] + args, input=stdin, capture_output=True,
+                          env=dict(os.environ, PYTHONIOENCODING='utf-8'))
+
+
+@pytest.mark.parametrize('command', [
+    r'g/\Afoo', r'x/\Afoo', r'X/\Afoo', r'G/foo\Z', r'r/\Af', r'g/foo\Z', r'g/\bfoo', r'x/\B',
+    r'g/^foo', r'x/foo$', r'o/fo+', r'G/[a-z]+', r'X/foo', 'S/o/0/', r'S/\Afoo/F/', r'S/foo\Z/F/',
+    'R/oo', r'O/fo+', r'S/\n/|/', 'S/a*/-/', r'S/\bfoo\b/F/',
+])
+@pytest.mark.parametrize('options', [[], ['-a'], ['-Z'], ['-M', '2']])
+def test_bytes_fast_path_matches_str_path(tmp_path, command, options):
+    path = tmp_path / 'in.txt'
+    path.write_bytes(TEXT.encode('utf-8'))
+    # reading stdin always takes the str path
+    expected = run_ped(options + [command], stdin=TEXT.encode('utf-8'))
+    actual = run_ped(options + ['-f', str(path), command])
+    assert (actual.stdout, actual.returncode) == (expected.stdout, expected.returncode)
+
+
+def safe(e, ascii_mode=False):
+    return ped.bytes_safe(argparse.Namespace(insensitive=0, ascii=re.ASCII if ascii_mode else 0), e)
+
+
+@pytest.mark.parametrize('e', ['.', 'a.b', '[^a]', r'\W', r'\S', r'\D', r'\x41', r'\N{DASH}',
+                               r'(?=a)', r'(?<!a)b', r'(?i)a', r'\1', 'é'])
+def test_bytes_safe_rejects(e):
+    assert not safe(e)[0]
+
+
+@pytest.mark.parametrize('e', [r'\w', r'\d', r'\s', r'\b', r'\B'])
+def test_bytes_safe_ascii_classes_need_ascii_mode(e):
+    assert not safe(e)[0]
+    assert safe(e, ascii_mode=True)[0]
+
+
+def test_bytes_safe_case_folding_needs_ascii_mode():
+    args = argparse.Namespace(insensitive=re.IGNORECASE, ascii=0)
+    assert not ped.bytes_safe(args, 'foo')[0]
+    args.ascii = re.ASCII
+    assert ped.bytes_safe(args, 'foo')[0]
+
+
+@pytest.mark.parametrize('e, line_local, anchors', [
+    ('foo', True, set()),
+    ('(?:foo|bar)+', True, set()),
+    ('(?P<name>ab)', True, set()),
+    ('^foo$', True, {'^', '$'}),
+    (r'\Afoo\Z', True, {'A', 'Z'}),
+    (r'\.\[', True, set()),
+    (r'foo\nbar', False, set()),
+    ('foo\nbar', False, set()),
+    ('[a-z]', True, set()),
+    (r'[\t-~]', False, set()),
+    ('[\x00-z]', False, set()),
+])
+def test_bytes_safe_classifies(e, line_local, anchors):
+    assert safe(e) == (True, line_local, anchors)
+
+
+def test_bytes_safe_word_anchors():
+    assert safe(r'\bfoo\B', ascii_mode=True) == (True, True, {'b', 'B'})
+
+
+def test_in_place_edit_backs_up_the_original(tmp_path):
+    path = tmp_path / 'in.txt'
+    path.write_bytes(b'one\ntwo\n')
+    backup_d = tmp_path / 'backups'
+    assert run_ped(['-e', '-b', str(backup_d), '-f', str(path), 's/o/0/']).returncode == 0
+    assert path.read_bytes() == b'0ne\ntw0\n'
+    assert [backup.read_bytes() for backup in backup_d.iterdir()] == [b'one\ntwo\n']
+
+
+def test_failed_in_place_edit_leaves_no_backup(tmp_path):
+    path = tmp_path / 'in.txt'
+    path.write_bytes(b'ok\n\xff bad\n')
+    backup_d = tmp_path / 'backups'
+    assert run_ped(['-e', '-b', str(backup_d), '-f', str(path), 's/o/0/']).returncode != 0
+    assert path.read_bytes() == b'ok\n\xff bad\n'
+    assert sorted(os.listdir(tmp_path)) == ['in.txt']
+
+
+def test_failed_stream_leaves_no_partial_output_in_a_file(tmp_path):
+    path = tmp_path / 'in.txt'
+    path.write_bytes(b'x\n' * (ped.BATCH_SIZE // 2) + b'\xff\n')
+    out_path = tmp_path / 'out.txt'
+    out_path.write_bytes(b'before\n')
+    with open(out_path, 'ab') as out:
+        result = subprocess.run([sys.executable, PED, '-f', str(path), 's/x/y/'], stdout=out)
+    assert result.returncode != 0
+    assert out_path.read_bytes() == b'before\n'